@@ -10,10 +10,11 @@ from sqlite3 import connect, Row, PARSE_DECLTYPES, register_adapter, register_co
 
 import click
 import yaml
-from flask import current_app, g
+from flask import current_app, g, request
 from flask.cli import with_appcontext
 from jinja2.tests import test_undefined
 
+from tools.internet.metrics import metrics
 from tools.utils.common import BaseEnum
 
 
@@ -33,6 +34,17 @@ def init_app(app):
     def hello():
         return 'Hello!'
 
+    @app.route('/metrics')
+    def spider_metrics():
+        """
+        params: reset=1, to clear metrics after getting them
+        :return: metrics of sites
+        """
+        snapshot = metrics.snapshot()
+        if request.args.get('reset', default=0, type=int) == 1:
+            metrics.reset()
+        return snapshot
+
 
 # config for logging
 def init_logging(app):
@@ -0,0 +1,136 @@
+""" Pool of headless browsers
+
+Browsers are started only when first used and shared by all sites. Pages are loaded without images and stylesheets.
+
+@Author Kingen
+@Date 2020/6/4
+"""
+import atexit
+import threading
+from contextlib import contextmanager
+
+from selenium import webdriver
+
+from . import logger
+
+CHROME_DRIVER = 'chromedriver 81.0.4044.138.exe'
+BLOCKED_URLS = ['*.css', '*.css?*']  # patterns of urls of stylesheets
+
+_pool = None
+_lock = threading.Lock()
+
+
+class BrowserPool:
+    """
+    At most 'size' Chrome instances are started. Callers wait for an idle one when all are busy.
+    """
+
+    def __init__(self, size=2, headless=True, block_resources=True, executable_path=CHROME_DRIVER) -> None:
+        """
+        :param headless: whether to run Chrome without a window
+        :param block_resources: whether to block images and stylesheets
+        """
+        self.__size = size
+        self.__headless = headless
+        self.__block_resources = block_resources
+        self.__executable_path = executable_path
+        self.__idle = []
+        self.__count = 0
+        self.__condition = threading.Condition()
+
+    @contextmanager
+    def driver(self):
+        """
+        Borrow a WebDriver and the page it's opening is reused by next borrower.
+        The driver is discarded if anything fails in the context, since its state is unknown.
+        """
+        chrome = self.__acquire()
+        ok = False
+        try:
+            yield chrome
+            ok = True
+        finally:
+            if ok:
+                self.__release(chrome)
+            else:
+                self.__discard(chrome)
+
+    def quit(self):
+        with self.__condition:
+            while len(self.__idle) > 0:
+                self.__idle.pop().quit()
+                self.__count -= 1
+
+    def __acquire(self):
+        with self.__condition:
+            while len(self.__idle) == 0 and self.__count >= self.__size:
+                self.__condition.wait()
+            if len(self.__idle) > 0:
+                return self.__idle.pop()
+            self.__count += 1
+        try:
+            return self.__start()
+        except Exception:
+            with self.__condition:
+                self.__count -= 1
+                self.__condition.notify()
+            raise
+
+    def __release(self, chrome):
+        with self.__condition:
+            self.__idle.append(chrome)
+            self.__condition.notify()
+
+    def __discard(self, chrome):
+        try:
+            chrome.quit()
+        except Exception as e:
+            logger.error(e)
+        with self.__condition:
+            self.__count -= 1
+            self.__condition.notify()
+
+    def __start(self):
+        logger.info('Starting Chrome')
+        options = webdriver.ChromeOptions()
+        if self.__headless:
+            options.add_argument('--headless')
+            options.add_argument('--disable-gpu')
+        if self.__block_resources:
+            options.add_argument('--blink-settings=imagesEnabled=false')
+            options.add_experimental_option('prefs', {'profile.managed_default_content_settings.images': 2})
+        chrome = webdriver.Chrome(executable_path=self.__executable_path, options=options)
+        if self.__block_resources:
+            # stylesheets aren't a content setting of Chrome, so they are blocked by urls
+            try:
+                chrome.execute_cdp_cmd('Network.enable', {})
+                chrome.execute_cdp_cmd('Network.setBlockedURLs', {'urls': BLOCKED_URLS})
+            except Exception:
+                chrome.quit()
+                raise
+        return chrome
+
+
+def init_browsers(size=2, headless=True, block_resources=True, executable_path=CHROME_DRIVER):
+    """
+    Replace the shared pool, quitting browsers of the former one.
+    """
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.quit()
+        _pool = BrowserPool(size, headless, block_resources, executable_path)
+
+
+def get_browsers() -> BrowserPool:
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = BrowserPool()
+        return _pool
+
+
+@atexit.register
+def _quit_browsers():
+    if _pool is not None:
+        _pool.quit()
@@ -0,0 +1,123 @@
+""" Caches of http responses
+
+Responses are keyed by method, url and body of the request. Bodies are stored compressed with headers of the
+response, which provide validators (ETag/Last-Modified) to revalidate stale entries.
+
+@Author Kingen
+@Date 2020/6/5
+"""
+import abc
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+_cache = None
+
+
+class CacheEntry:
+    def __init__(self, body: bytes, headers: dict, stored=None, status=200) -> None:
+        """
+        :param headers: headers of the response with lower-case names
+        :param stored: timestamp when the response is stored or revalidated
+        :param status: status code of the response
+        """
+        self.body = body
+        self.headers = headers
+        self.stored = stored if stored is not None else time.time()
+        self.status = status
+
+    def is_fresh(self, ttl) -> bool:
+        return time.time() - self.stored < ttl
+
+    def validators(self) -> dict:
+        """
+        :return: headers of a conditional request to revalidate the entry
+        """
+        headers = {}
+        if 'etag' in self.headers:
+            headers['If-None-Match'] = self.headers['etag']
+        if 'last-modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['last-modified']
+        return headers
+
+
+class BaseCache(abc.ABC):
+
+    @abc.abstractmethod
+    def get(self, key) -> CacheEntry:
+        """
+        :return: the entry or None if not found
+        """
+        pass
+
+    @abc.abstractmethod
+    def set(self, key, entry: CacheEntry):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+
+class FileCache(BaseCache):
+    """
+    Each entry is stored as a gzip file, whose first line is the json of headers and others are the body.
+    """
+
+    def __init__(self, directory, compress_level=6) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.__directory = directory
+        self.__compress_level = compress_level
+
+    def get(self, key) -> CacheEntry:
+        path = self.__path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with gzip.open(path, 'rb') as fp:
+                meta = json.loads(fp.readline().decode('utf-8'))
+                return CacheEntry(fp.read(), meta['headers'], meta['stored'], meta.get('status', 200))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def set(self, key, entry: CacheEntry):
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = json.dumps({'headers': entry.headers, 'stored': entry.stored, 'status': entry.status}, ensure_ascii=False)
+        temp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with gzip.open(temp, 'wb', compresslevel=self.__compress_level) as fp:
+            fp.write(meta.encode('utf-8') + b'\n')
+            fp.write(entry.body)
+        os.replace(temp, path)
+
+    def delete(self, key):
+        path = self.__path(key)
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def __path(self, key):
+        return os.path.join(self.__directory, key[:2], key + '.gz')
+
+
+def cache_key(method, url, data=None) -> str:
+    md5 = hashlib.md5()
+    md5.update(method.upper().encode('utf-8'))
+    md5.update(b' ' + url.encode('utf-8'))
+    if data is not None:
+        md5.update(b' ' + data)
+    return md5.hexdigest()
+
+
+def init_cache(cache: BaseCache = None):
+    """
+    Set the cache of responses shared by all sites. Responses aren't cached if it's None.
+    """
+    global _cache
+    _cache = cache
+
+
+def get_cache() -> BaseCache:
+    return _cache
@@ -0,0 +1,81 @@
+""" Record and replay of requests
+
+In 'record' mode, responses of requests, probes of downloads and pages of browsers are saved to a cassette directory.
+In 'replay' mode, they are served from the directory without network, so that sites can be run deterministically.
+
+@Author Kingen
+@Date 2020/6/10
+"""
+import json
+
+from . import logger
+from .cache import FileCache, CacheEntry, cache_key
+
+RECORD = 'record'
+REPLAY = 'replay'
+
+_cassette = None
+
+
+class NotRecordedError(LookupError):
+    """
+    Raised when replaying a request which isn't recorded.
+    """
+    pass
+
+
+class Cassette:
+    def __init__(self, directory, mode=REPLAY) -> None:
+        if mode not in (RECORD, REPLAY):
+            raise ValueError('Unknown mode of cassette: %s' % mode)
+        self.__files = FileCache(directory)
+        self.__mode = mode
+
+    @property
+    def recording(self):
+        return self.__mode == RECORD
+
+    @property
+    def replaying(self):
+        return self.__mode == REPLAY
+
+    def record_response(self, method, url, data, entry: CacheEntry):
+        self.__files.set(cache_key(method, url, data), entry)
+
+    def replay_response(self, method, url, data=None) -> CacheEntry:
+        """
+        :raise NotRecordedError
+        """
+        return self.__load(cache_key(method, url, data), url)
+
+    def record_probe(self, url, info: dict):
+        self.__files.set(cache_key('PROBE', url), CacheEntry(json.dumps(info).encode('utf-8'), {}))
+
+    def replay_probe(self, url) -> dict:
+        return json.loads(self.__load(cache_key('PROBE', url), url).body.decode('utf-8'))
+
+    def record_page(self, url, source: str):
+        self.__files.set(cache_key('BROWSER', url), CacheEntry(source.encode('utf-8'), {}))
+
+    def replay_page(self, url) -> str:
+        return self.__load(cache_key('BROWSER', url), url).body.decode('utf-8')
+
+    def __load(self, key, url):
+        entry = self.__files.get(key)
+        if entry is None:
+            logger.error('Not recorded: %s', url)
+            raise NotRecordedError('Not recorded: %s' % url)
+        logger.info('Replay %s', url)
+        return entry
+
+
+def init_cassette(directory=None, mode=REPLAY):
+    """
+    Record or replay requests of all sites with the directory. Disabled if directory is None.
+    """
+    global _cassette
+    _cassette = Cassette(directory, mode) if directory is not None else None
+
+
+def get_cassette() -> Cassette:
+    return _cassette
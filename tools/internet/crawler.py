@@ -0,0 +1,194 @@
+""" Resumable crawler of celebrities and their works on Douban
+
+Starting from celebrities followed by a user, the crawler expands to works of celebrities and co-workers in the
+works. Pages to crawl make up a frontier stored in a SQLite database with results. Each page is checkpointed once
+done, so a crawl interrupted by errors or crashes resumes from where it stopped, instead of from zero.
+
+@Author Kingen
+@Date 2020/6/12
+"""
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import logger
+from .douban import Douban
+
+PENDING, DONE, FAILED = 0, 1, 2
+
+PEOPLE = 'people'  # page of celebrities followed by the user
+CELEBRITY = 'celebrity'  # info of a celebrity
+WORKS = 'works'  # page of works of a celebrity
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS crawl_frontier
+(
+    crawl    TEXT    NOT NULL,
+    kind     TEXT    NOT NULL, -- people/celebrity/works
+    key      TEXT    NOT NULL, -- id of the user or the celebrity
+    start    INTEGER NOT NULL, -- start index of the page
+    depth    INTEGER NOT NULL, -- 0 for followed celebrities, +1 for co-workers
+    status   INTEGER NOT NULL, -- 0: pending, 1: done, 2: failed
+    attempts INTEGER NOT NULL,
+    PRIMARY KEY (crawl, kind, key, start)
+);
+CREATE TABLE IF NOT EXISTS crawl_item
+(
+    crawl TEXT NOT NULL,
+    kind  TEXT NOT NULL, -- celebrity/subject
+    id    TEXT NOT NULL,
+    data  TEXT NOT NULL, -- json
+    PRIMARY KEY (crawl, kind, id)
+);
+'''
+
+
+class CelebrityCrawler:
+    def __init__(self, douban: Douban, db_path, user_id, max_depth=1, workers=3, max_attempts=3, count=Douban.COUNT):
+        """
+        :param max_depth: max depth of celebrities to expand, co-workers of celebrities at max_depth are not crawled
+        :param workers: max count of pages requested at the same time, still limited by the interval of Douban
+        :param max_attempts: a page is marked failed after attempts and skipped by later runs
+        :param count: count of works in a page
+        """
+        self.__douban = douban
+        self.__db = db_path
+        self.__crawl = 'celebrities:%s' % user_id
+        self.__user_id = user_id
+        self.__max_depth = max_depth
+        self.__workers = workers
+        self.__max_attempts = max_attempts
+        self.__count = count
+        self.__con = None
+
+    def run(self):
+        """
+        Crawl until no pending pages left. It's safe to call again after interrupted.
+        :return: (count of pages done, count of pages failed) in this run
+        """
+        self.__con = sqlite3.connect(self.__db, timeout=30)
+        try:
+            self.__con.executescript(SCHEMA)
+            self.__add_tasks([(PEOPLE, self.__user_id, 0, 0)])
+            self.__con.commit()
+            return self.__run()
+        finally:
+            self.__con.close()
+            self.__con = None
+
+    def reset_failed(self):
+        """
+        Mark failed pages pending to retry them by next run.
+        :return: count of pages reset
+        """
+        with sqlite3.connect(self.__db, timeout=30) as con:
+            con.executescript(SCHEMA)
+            return con.execute('UPDATE crawl_frontier SET status = ?, attempts = 0 WHERE crawl = ? AND status = ?',
+                               (PENDING, self.__crawl, FAILED)).rowcount
+
+    def items(self, kind=CELEBRITY):
+        """
+        :param kind: celebrity/subject
+        :return: {'<id>': {<data>},...} crawled
+        """
+        with sqlite3.connect(self.__db, timeout=30) as con:
+            rows = con.execute('SELECT id, data FROM crawl_item WHERE crawl = ? AND kind = ?', (self.__crawl, kind))
+            return dict([(x[0], json.loads(x[1])) for x in rows.fetchall()])
+
+    def __run(self):
+        done_count = failed_count = 0
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            try:
+                while True:
+                    for task in self.__next_tasks(self.__workers - len(futures), futures.values()):
+                        futures[executor.submit(self.__fetch, *task[:3])] = task
+                    if len(futures) == 0:
+                        break
+                    done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        task = futures.pop(future)
+                        try:
+                            self.__checkpoint(task, future.result())
+                            done_count += 1
+                        except Exception as e:
+                            logger.error('Failed to crawl %s %s from %d: %s', task[0], task[1], task[2], e)
+                            if self.__fail(task):
+                                failed_count += 1
+            finally:
+                for future in futures:
+                    future.cancel()
+        logger.info('Finish crawling %s: %d pages done, %d failed', self.__crawl, done_count, failed_count)
+        return done_count, failed_count
+
+    def __fetch(self, kind, key, start):
+        if kind == PEOPLE:
+            return self.__douban.movie_people_celebrities(key, start=start)
+        if kind == CELEBRITY:
+            return self.__douban.api_movie_celebrity(key)
+        if kind == WORKS:
+            return self.__douban.api_movie_celebrity_works(key, start=start, count=self.__count)
+        raise ValueError('Unknown kind: %s' % kind)
+
+    def __checkpoint(self, task, data):
+        """
+        Save results of the page and pages found in it, and mark the page done, in one transaction.
+        """
+        kind, key, start, depth = task
+        tasks, items = [], []
+        if kind == PEOPLE:
+            tasks += [(CELEBRITY, x['id'], 0, depth) for x in data['subjects']]
+            if start == 0 and len(data['subjects']) > 0:
+                tasks += [(PEOPLE, key, x, depth) for x in range(len(data['subjects']), data['total'], len(data['subjects']))]
+        elif kind == CELEBRITY:
+            items.append((CELEBRITY, key, data))
+            tasks.append((WORKS, key, 0, depth))
+        elif kind == WORKS:
+            for work in data['works']:
+                subject = work['subject']
+                items.append(('subject', subject['id'], subject))
+                if depth < self.__max_depth:
+                    for celebrity in subject.get('directors', []) + subject.get('casts', []):
+                        if celebrity.get('id'):
+                            tasks.append((CELEBRITY, celebrity['id'], 0, depth + 1))
+            if start == 0 and data['count'] > 0:
+                tasks += [(WORKS, key, x, depth) for x in range(data['count'], data['total'], data['count'])]
+        with self.__con:
+            self.__add_tasks(tasks)
+            self.__con.executemany('INSERT OR REPLACE INTO crawl_item(crawl, kind, id, data) VALUES (?, ?, ?, ?)',
+                                   [(self.__crawl, k, str(i), json.dumps(d, ensure_ascii=False)) for k, i, d in items])
+            self.__con.execute('UPDATE crawl_frontier SET status = ? WHERE crawl = ? AND kind = ? AND key = ? AND start = ?',
+                               (DONE, self.__crawl, kind, str(key), start))
+
+    def __fail(self, task):
+        """
+        :return: whether the page is marked failed
+        """
+        kind, key, start, depth = task
+        with self.__con:
+            self.__con.execute('UPDATE crawl_frontier SET attempts = attempts + 1, '
+                               'status = CASE WHEN attempts + 1 >= ? THEN ? ELSE status END '
+                               'WHERE crawl = ? AND kind = ? AND key = ? AND start = ?',
+                               (self.__max_attempts, FAILED, self.__crawl, kind, str(key), start))
+            row = self.__con.execute('SELECT status FROM crawl_frontier WHERE crawl = ? AND kind = ? AND key = ? AND start = ?',
+                                     (self.__crawl, kind, str(key), start)).fetchone()
+        return row is not None and row[0] == FAILED
+
+    def __add_tasks(self, tasks):
+        """
+        Add pages to the frontier, ignoring ones already in it.
+        """
+        self.__con.executemany('INSERT OR IGNORE INTO crawl_frontier(crawl, kind, key, start, depth, status, attempts) '
+                               'VALUES (?, ?, ?, ?, ?, ?, 0)',
+                               [(self.__crawl, k, str(i), s, d, PENDING) for k, i, s, d in tasks])
+
+    def __next_tasks(self, limit, running):
+        """
+        :return: pending pages not running, shallower and fewer attempted ones first
+        """
+        if limit <= 0:
+            return []
+        running = set([x[:3] for x in running])
+        rows = self.__con.execute('SELECT kind, key, start, depth FROM crawl_frontier WHERE crawl = ? AND status = ? '
+                                  'ORDER BY depth, attempts LIMIT ?', (self.__crawl, PENDING, limit + len(running)))
+        return [x for x in rows.fetchall() if tuple(x[:3]) not in running][:limit]
@@ -7,75 +7,161 @@ Json files in the 'douban' directory are examples  for each functions
 @Author Kingen
 @Date 2020/5/6
 """
+import html
 import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from urllib import parse
 from urllib.request import Request
 
 import bs4
+from bs4 import SoupStrainer
 
 from . import logger
+from .metrics import metrics, timed
+from .results import cached
 from .spider import BaseSite
 
+HOUR = 3600  # seconds
+DAY = 24 * HOUR
+WEEK = 7 * DAY
+
 
 class Douban(BaseSite):
     COUNT = 20
     START_DATE = '2005-03-06'
+    RECORD_CATEGORIES = ['wish', 'do', 'collect']
+    SUBJECT_CACHE_TTL = DAY  # seconds
+    KEYWORDS_REGEX = re.compile(r'<meta\s+name="keywords"\s+content="([^"]*)"')
+    YEAR_REGEX = re.compile(r'<span\s+class="year">\(\s*(\d+)\s*\)</span>')
 
     def __init__(self, api_key) -> None:
         super().__init__('Douban', 'douban.com', interval=5)
         self.__api_key = api_key
 
-    def collect_user_movies(self, my_id, start_date=START_DATE):
+    @timed
+    def collect_user_movies(self, my_id, start_date=START_DATE, workers=3, watermarks=None):
         """
         collect my movies data since start_date with cookie got manually.
-        :return: {'<id>': {<simple-subject>},...}
+        Pages of all categories are requested concurrently by turns, at most 'workers' pages in flight. Pages of a
+        category are consumed in order as they arrive, and its pending pages are cancelled once its bound is reached.
+        :param workers: max count of pages requested at the same time, still limited by the interval of the site
+        :param watermarks: {'<record_cat>': (tag_date, id)} of the latest subject synced in each category. A category
+                with a watermark is collected since its tag_date and stops at the subject with its id, instead of
+                start_date.
+        :return: {'<id>': {<simple-subject>},...}, subjects of each category are in order of tag_date desc
         """
-        subjects = {}
-        for record_cat in ['wish', 'do', 'collect']:
-            start = 0
-            while True:
-                done = False
-                records = self.__parse_collections_page(my_id, catalog='movie', record_cat=record_cat, sort_by='time', start=start)
-                for subject in records['subjects']:
-                    if subject['tag_date'] >= start_date:
-                        subjects[subject['id']] = subject
-                    else:
-                        done = True
+        if start_date is None:
+            start_date = self.START_DATE
+        if watermarks is None:
+            watermarks = {}
+        bounds = dict([(x, watermarks.get(x, (start_date, None))) for x in self.RECORD_CATEGORIES])
+        # frontier of each category: offsets to request, next offset to consume and pages arrived out of order
+        frontiers = dict([(x, {'offsets': [0], 'next': 0, 'pages': {}}) for x in self.RECORD_CATEGORIES])
+        subjects, futures = {}, {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            try:
+                while True:
+                    # submit by turns so that all categories go forward together
+                    while len(futures) < workers and any([len(x['offsets']) > 0 for x in frontiers.values()]):
+                        for record_cat, frontier in frontiers.items():
+                            if len(futures) < workers and len(frontier['offsets']) > 0:
+                                start = frontier['offsets'].pop(0)
+                                future = executor.submit(self.__parse_collections_page, my_id, catalog='movie',
+                                                         record_cat=record_cat, sort_by='time', start=start)
+                                futures[future] = (record_cat, start)
+                    if len(futures) == 0:
                         break
-                start += records['count']
-                if start >= records['total'] or done:
-                    break
+                    done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        record_cat, start = futures.pop(future)
+                        frontier = frontiers[record_cat]
+                        if frontier['next'] is None:
+                            # the category is finished while the page is running
+                            continue
+                        records = future.result()
+                        if start == 0 and records['count'] > 0:
+                            frontier['offsets'] = list(range(records['count'], records['total'], records['count']))
+                        frontier['pages'][start] = records
+                        while frontier['next'] in frontier['pages']:
+                            records = frontier['pages'].pop(frontier['next'])
+                            if self.__add_records(subjects, records, *bounds[record_cat]) or records['count'] == 0:
+                                self.__finish(frontier, record_cat, futures)
+                                break
+                            frontier['next'] += records['count']
+            finally:
+                for future in futures:
+                    future.cancel()
         return subjects
 
+    @staticmethod
+    def __finish(frontier: dict, record_cat, futures: dict):
+        """
+        Stop requesting pages of the category and cancel its pending pages
+        """
+        frontier['offsets'], frontier['next'], frontier['pages'] = [], None, {}
+        for future, (cat, start) in list(futures.items()):
+            if cat == record_cat and future.cancel():
+                del futures[future]
+
+    @staticmethod
+    def __add_records(subjects: dict, records, start_date, last_id=None):
+        """
+        Add subjects of the page whose tag_date isn't earlier than start_date, until the subject of last_id.
+        The subject of last_id is a bound only if it isn't marked again after start_date.
+        :return: whether start_date or last_id is reached
+        """
+        for subject in records['subjects']:
+            if subject['tag_date'] < start_date or (subject['id'] == last_id and subject['tag_date'] <= start_date):
+                return True
+            subjects[subject['id']] = subject
+        return False
+
+    @timed
     def collect_hit_movies(self):
         """
         collect current hit movies
         :return: {'<id>': {<simple-subject>},...}
         """
-        start = 0
-        movies = {}
-        while True:
-            data = self.api_movie_in_theaters(start=start)
-            for subject in data['subjects']:
-                if subject['id'] not in movies:
-                    movies[subject['id']] = subject
-            start += data['count']
-            if start >= data['total']:
-                break
-
-        data = self.api_movie_new_movies()
-        for subject in data['subjects']:
-            if subject['id'] not in movies:
-                movies[subject['id']] = subject
-
-        data = self.api_movie_weekly()
-        for subject in [subject['subject'] for subject in data['subjects']]:
-            if subject['id'] not in movies:
-                movies[subject['id']] = subject
-
-        return movies
+        return dict(self.iter_hit_movies())
+
+    def iter_hit_movies(self, workers=3):
+        """
+        Iterate current hit movies in theaters, new movies and weekly movies, which are requested concurrently.
+        Left pages of movies in theaters are requested once the total is known.
+        Movies are generated as soon as their pages arrive, so the order isn't fixed.
+        :param workers: max count of requests at the same time, still limited by the interval of the site
+        :return: generator of ('<id>', {<simple-subject>}), without duplicate ids
+        """
+        ids = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(self.api_movie_in_theaters, start=0): 'in_theaters',
+                executor.submit(self.api_movie_new_movies): 'new_movies',
+                executor.submit(self.api_movie_weekly): 'weekly'
+            }
+            try:
+                while len(futures) > 0:
+                    done, pending = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        source = futures.pop(future)
+                        data = future.result()
+                        if source == 'in_theaters' and data['count'] > 0:
+                            # fan out left pages once the total is known
+                            for start in range(data['count'], data['total'], data['count']):
+                                futures[executor.submit(self.api_movie_in_theaters, start=start)] = 'in_theaters_page'
+                        if source == 'weekly':
+                            subjects = [x['subject'] for x in data['subjects']]
+                        else:
+                            subjects = data['subjects']
+                        for subject in subjects:
+                            if subject['id'] not in ids:
+                                ids.add(subject['id'])
+                                yield subject['id'], subject
+            finally:
+                for future in futures:
+                    future.cancel()
 
     def movie_people_celebrities(self, user_id, start=0):
         return self.__parse_creators_page(user_id, cat='movie', start=start)
@@ -89,6 +175,7 @@ class Douban(BaseSite):
     def movie_people_collect(self, user_id, start=0):
         return self.__parse_collections_page(user_id, catalog='movie', record_cat='collect', start=start)
 
+    @timed
     def movie_subject(self, subject_id):
         """
         This is a backup for movies that can't be found by self.api_movie_subject().
@@ -98,16 +185,23 @@ class Douban(BaseSite):
         """
         url = self._get_url('/subject/{id}', low_domain='movie', path_params={'id': subject_id})
         req = Request(url, method='GET')
-        soup = self.get_soup(req)
-        wrapper = soup.find('div', id='wrapper')
-        subject = {}
+        return self.parse_subject(self.do_request(req, ttl=self.SUBJECT_CACHE_TTL))
 
-        keywords = [x.strip() for x in soup.find('meta', {'name': 'keywords'})['content'].split(',')]
+    def parse_subject(self, content):
+        """
+        Parse the page of a subject.
+        Only div#info is parsed into a tree and walked, the title and the year are read from the raw page.
+        """
+        # keywords are in the head, out of the info which is parsed only
+        keywords = [x.strip() for x in html.unescape(self.KEYWORDS_REGEX.search(content).group(1)).split(',')]
+        info = self._parse(content, SoupStrainer('div', id='info')).find('div', id='info')
+
+        subject = {}
         subject['title'] = keywords[0]
         subject['original_title'] = keywords[1]
-        subject['year'] = int(wrapper.find('h1').find('span', class_='year').get_text().strip('( )'))
+        subject['year'] = int(self.YEAR_REGEX.search(content).group(1))
 
-        spans = dict([(span_pl.get_text().strip(), span_pl) for span_pl in wrapper.find('div', id='info').find_all('span', class_='pl')])
+        spans = dict([(span_pl.get_text().strip(), span_pl) for span_pl in info.find_all('span', class_='pl')])
         for pl in ['导演', '编剧', '主演']:
             if pl in spans:
                 celebrities = []
@@ -169,39 +263,50 @@ class Douban(BaseSite):
 
         return subject
 
+    @cached(DAY)
     def api_movie_subject(self, subject_id):
         return self.__get_api_result('/v2/movie/subject/{id}', {'id': subject_id})
 
+    @cached(DAY)
     def api_movie_subject_photos(self, subject_id, start=0, count=20):
         return self.__get_api_result('/v2/movie/subject/{id}/photos', {'id': subject_id}, {'start': start, 'count': count})
 
+    @cached(HOUR)
     def api_movie_subject_reviews(self, subject_id, start=0, count=20):
         return self.__get_api_result('/v2/movie/subject/{id}/reviews', {'id': subject_id}, {'start': start, 'count': count})
 
+    @cached(HOUR)
     def api_movie_subject_comments(self, subject_id, start=0, count=20):
         return self.__get_api_result('/v2/movie/subject/{id}/comments', {'id': subject_id}, {'start': start, 'count': count})
 
+    @cached(DAY)
     def api_movie_celebrity(self, celebrity_id):
         return self.__get_api_result('/v2/movie/celebrity/{id}', {'id': celebrity_id})
 
+    @cached(DAY)
     def api_movie_celebrity_photos(self, celebrity_id, start=0, count=20):
         return self.__get_api_result('/v2/movie/celebrity/{id}/photos', {'id': celebrity_id}, {'start': start, 'count': count})
 
+    @cached(DAY)
     def api_movie_celebrity_works(self, celebrity_id, start=0, count=20):
         return self.__get_api_result('/v2/movie/celebrity/{id}/works', {'id': celebrity_id}, {'start': start, 'count': count})
 
+    @cached(WEEK)
     def api_movie_top250(self, start=0, count=COUNT):
         return self.__get_api_result('/v2/movie/top250', query_params={
             'start': start,
             'count': count
         })
 
+    @cached(DAY)
     def api_movie_weekly(self):
         return self.__get_api_result('/v2/movie/weekly')
 
+    @cached(DAY)
     def api_movie_new_movies(self):
         return self.__get_api_result('/v2/movie/new_movies')
 
+    @cached(HOUR)
     def api_movie_in_theaters(self, start=0, count=COUNT, city='北京'):
         """
         :param city: name or number id of the city
@@ -212,12 +317,14 @@ class Douban(BaseSite):
             'city': city
         })
 
+    @cached(HOUR)
     def api_movie_coming_soon(self, start=0, count=COUNT):
         return self.__get_api_result('/v2/movie/coming_soon', query_params={
             'start': start,
             'count': count
         })
 
+    @timed
     def __parse_creators_page(self, user_id, cat='movie', start=0):
         """
         :param user_id:
@@ -228,7 +335,7 @@ class Douban(BaseSite):
         catalogs = {'movie': 'celebrities', 'book': 'authors', 'music': 'musicians'}
         url = self._get_url('/people/{id}/{cat}', low_domain=cat, path_params={'id': user_id, 'cat': catalogs[cat]},
                             query_params={'start': start})
-        soup = self.get_soup(url)
+        soup = self.get_soup(url, parse_only=SoupStrainer('div', id='content'))
         results = []
         content = soup.find('div', id='content')
         for div in content.find('div', class_='article').find_all('div', class_='item'):
@@ -238,7 +345,7 @@ class Douban(BaseSite):
                 'name': a.get_text().strip(),
             })
         h1 = str(content.find('div', id='db-usr-profile').find('div', class_='info').find('h1').get_text())
-        total = int(re.search(r'\(\d+\)', h1)[0])
+        total = int(re.search(r'\((\d+)\)', h1).group(1))
         return {
             'start': start,
             'count': len(results),
@@ -246,6 +353,7 @@ class Douban(BaseSite):
             'subjects': results
         }
 
+    @timed
     def __parse_collections_page(self, user_id, catalog='movie', record_cat='wish', sort_by='time', start=0):
         """
         Get user records
@@ -261,7 +369,7 @@ class Douban(BaseSite):
         """
         url = self._get_url(path='/people/{id}/{cat}', low_domain=catalog, path_params={'id': user_id, 'cat': record_cat},
                             query_params={'sort': sort_by, 'start': start, 'mode': 'list'})
-        soup = self.get_soup(url)
+        soup = self.get_soup(url, parse_only=SoupStrainer('div', id='content'))
         results = []
         for li in soup.find('ul', class_='list-view').find_all('li'):
             div = li.div.div
@@ -293,18 +401,24 @@ class Douban(BaseSite):
 
     def __get_api_result(self, relative_url, path_params=None, query_params=None):
         url = self._get_url(path=relative_url, low_domain='api', path_params=path_params, query_params=query_params)
-        return json.loads(self.do_request(url), encoding='utf-8')
+        with metrics.method(type(self).__name__, relative_url):
+            # results are cached by cached() instead of responses
+            return json.loads(self.do_request(url, ttl=0))
 
 
 class IMDb(BaseSite):
+    TECHNICAL_TTL = 180 * DAY  # seconds, runtimes hardly change
 
     def __init__(self) -> None:
         super().__init__('IMDb', 'imdb.com', interval=5)
 
+    @cached(TECHNICAL_TTL)
+    @timed
     def title_technical(self, tt: int):
         title = {'id': tt, 'durations': []}
         url = 'https://www.imdb.com/title/tt%07d/technical' % tt
-        table = self.get_soup(url).find('div', id='technical_content').find('table')
+        table = self.get_soup(url, parse_only=SoupStrainer('div', id='technical_content')) \
+            .find('div', id='technical_content').find('table')
         if table is not None:
             for tr in table.find_all('tr'):
                 label = tr.find('td', class_='label')
@@ -0,0 +1,53 @@
+""" Coalescing of concurrent identical calls
+
+When a call with a key is in flight, callers with the same key wait for it and share its result or exception,
+instead of doing the same work again.
+
+@Author Kingen
+@Date 2020/6/8
+"""
+import threading
+
+from . import logger
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self) -> None:
+        self.__calls = {}
+        self.__lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Call the function, or wait for the call in flight with the same key.
+        """
+        with self.__lock:
+            call = self.__calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.__calls[key] = call
+        if not leader:
+            logger.info('Waiting for the call in flight: %s', key)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.done.set()
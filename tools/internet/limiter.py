@@ -0,0 +1,124 @@
+""" Rate limiters shared by sites of the same domain
+
+Token buckets are kept process-wide and keyed by domain so that every instance of a site keeps to the same budget.
+Buckets can also be stored in a SQLite database to be shared across processes, like workers of gunicorn.
+
+@Author Kingen
+@Date 2020/6/3
+"""
+import sqlite3
+import threading
+import time
+
+_lock = threading.Lock()
+_buckets = {}
+_db_path = None
+
+
+class TokenBucket:
+    """
+    A bucket holding at most 'capacity' tokens and refilled by 'rate' tokens per second.
+    Each access takes a token. When the bucket is empty, tokens are borrowed in advance and the caller has to wait
+    until its token is refilled, so concurrent callers queue up.
+    """
+
+    def __init__(self, rate, capacity=1) -> None:
+        """
+        :param rate: tokens refilled per second, no limit if it's not positive
+        :param capacity: max tokens kept, allowing bursts of accesses
+        """
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.time()
+        self.__lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    @property
+    def capacity(self):
+        return self.__capacity
+
+    def reserve(self) -> float:
+        """
+        Take a token
+        :return: seconds to wait before the token is available
+        """
+        if self.__rate <= 0:
+            return 0
+        with self.__lock:
+            now = time.time()
+            self.__tokens, waiting = self._take(self.__tokens, now - self.__updated)
+            self.__updated = now
+            return waiting
+
+    def _take(self, tokens, elapsed):
+        """
+        :return: (left tokens, seconds to wait)
+        """
+        tokens = min(self.__capacity, tokens + elapsed * self.__rate) - 1
+        return tokens, max(0.0, -tokens / self.__rate)
+
+
+class SqliteTokenBucket(TokenBucket):
+    """
+    A token bucket stored in a SQLite database, shared by all processes using the same database.
+    """
+
+    def __init__(self, db_path, key, rate, capacity=1) -> None:
+        super().__init__(rate, capacity)
+        self.__db = db_path
+        self.__key = key
+
+    def reserve(self) -> float:
+        if self.rate <= 0:
+            return 0
+        con = sqlite3.connect(self.__db, timeout=30, isolation_level=None)
+        try:
+            con.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = con.execute('SELECT tokens, updated FROM token_bucket WHERE key = ?', (self.__key,)).fetchone()
+            if row is None:
+                tokens, waiting = self._take(self.capacity, 0)
+            else:
+                tokens, waiting = self._take(row[0], now - row[1])
+            con.execute('INSERT OR REPLACE INTO token_bucket(key, tokens, updated) VALUES (?, ?, ?)', (self.__key, tokens, now))
+            con.execute('COMMIT')
+            return waiting
+        except sqlite3.Error:
+            if con.in_transaction:
+                con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+
+
+def init_limiter(db_path=None):
+    """
+    Specify where to store buckets. They are kept in memory of current process if db_path is None.
+    """
+    global _db_path
+    if db_path is not None:
+        with sqlite3.connect(db_path) as con:
+            con.execute('CREATE TABLE IF NOT EXISTS token_bucket(key TEXT NOT NULL PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+    with _lock:
+        _db_path = db_path
+        _buckets.clear()
+
+
+def get_bucket(domain, interval, burst=1) -> TokenBucket:
+    """
+    Get the bucket of the domain, which is created with the arguments when first got.
+    :param interval: average seconds between two accesses
+    :param burst: max accesses without waiting
+    """
+    with _lock:
+        if domain not in _buckets:
+            rate = 1 / interval if interval > 0 else 0
+            if _db_path is None:
+                _buckets[domain] = TokenBucket(rate, burst)
+            else:
+                _buckets[domain] = SqliteTokenBucket(_db_path, domain, rate, burst)
+        return _buckets[domain]
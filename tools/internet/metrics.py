@@ -0,0 +1,142 @@
+""" Metrics of sites
+
+Latencies of requests, waits for rate limits, parsing and browsers are observed into histograms, and bytes, retries
+and errors are counted. Metrics are grouped by the site (name of the BaseSite subclass) and the method of the site
+being run, which is tracked by timed() for each thread.
+
+@Author Kingen
+@Date 2020/6/9
+"""
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)  # seconds
+NO_METHOD = '-'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS) -> None:
+        self.__buckets = buckets
+        self.__counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.__buckets):
+            if value <= bound:
+                self.__counts[i] += 1
+                return
+        self.__counts[-1] += 1
+
+    def snapshot(self) -> dict:
+        buckets, total = {}, 0
+        for bound, count in zip(list(self.__buckets) + ['+Inf'], self.__counts):
+            total += count
+            buckets[str(bound)] = total
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'avg': round(self.sum / self.count, 6) if self.count > 0 else 0,
+            'max': round(self.max, 6),
+            'buckets': buckets
+        }
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.__histograms = {}
+        self.__counters = {}
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+
+    def observe(self, site, name, value, method=None):
+        """
+        :param method: method of the site, current method of the thread by default
+        """
+        key = (site, method or self.current_method(), name)
+        with self.__lock:
+            if key not in self.__histograms:
+                self.__histograms[key] = Histogram()
+            self.__histograms[key].observe(value)
+
+    def count(self, site, name, value=1, method=None):
+        key = (site, method or self.current_method(), name)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, site, name):
+        """
+        Observe seconds spent in the context
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(site, name, time.time() - start)
+
+    @contextmanager
+    def method(self, site, method):
+        """
+        Run the method of the site in the context. Its calls are timed and metrics observed in the context are
+        grouped by it.
+        """
+        stack = self.__stack()
+        stack.append(method)
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.count(site, 'errors', method=method)
+            raise
+        finally:
+            stack.pop()
+            self.observe(site, 'calls', time.time() - start, method=method)
+
+    def current_method(self):
+        stack = self.__stack()
+        return stack[-1] if len(stack) > 0 else NO_METHOD
+
+    def snapshot(self) -> dict:
+        """
+        :return: {site: {method: {name: histogram or count},...},...}
+        """
+        result = {}
+        with self.__lock:
+            for (site, method, name), histogram in self.__histograms.items():
+                result.setdefault(site, {}).setdefault(method, {})[name] = histogram.snapshot()
+            for (site, method, name), value in self.__counters.items():
+                result.setdefault(site, {}).setdefault(method, {})[name] = value
+        return result
+
+    def reset(self):
+        with self.__lock:
+            self.__histograms.clear()
+            self.__counters.clear()
+
+    def __stack(self) -> list:
+        if not hasattr(self.__local, 'stack'):
+            self.__local.stack = []
+        return self.__local.stack
+
+
+metrics = Metrics()
+
+
+def timed(func):
+    """
+    Decorator to run a method of a site by metrics.method()
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with metrics.method(type(self).__name__, func.__name__):
+            return func(self, *args, **kwargs)
+
+    return wrapper
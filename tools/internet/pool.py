@@ -0,0 +1,229 @@
+""" Pools of persistent http/https connections
+
+Connections are kept alive and reused by requests to the same host, avoiding a new TCP and TLS handshake for every
+request. A response has to be read to the end before its connection goes back to the pool.
+
+@Author Kingen
+@Date 2020/6/2
+"""
+import io
+import socket
+import threading
+import time
+from collections import deque
+from http import client
+from urllib import parse, error
+from urllib.request import Request
+
+from . import logger
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTIONS = 10
+
+
+class ConnectionPool:
+    """
+    Idle connections to one host, at most maxsize of them are kept.
+    """
+
+    def __init__(self, scheme, host, port=None, maxsize=4, idle_timeout=60.0) -> None:
+        """
+        :param maxsize: max count of idle connections to keep
+        :param idle_timeout: seconds after which an idle connection is discarded
+        """
+        if scheme not in ('http', 'https'):
+            raise ValueError('Unsupported scheme: %s' % scheme)
+        self.__scheme = scheme
+        self.__host = host
+        self.__port = port
+        self.__maxsize = maxsize
+        self.__idle_timeout = idle_timeout
+        self.__idle = deque()
+        self.__lock = threading.Lock()
+        self.__opened = 0
+
+    @property
+    def host(self):
+        return self.__host
+
+    @property
+    def opened(self):
+        """
+        Count of connections opened by the pool, less than requests over it if connections are reused
+        """
+        return self.__opened
+
+    def get(self, timeout):
+        """
+        Get an idle connection or a new one if none is available
+        :return: (connection, whether it's reused)
+        """
+        now = time.time()
+        with self.__lock:
+            while len(self.__idle) > 0:
+                con, last_used = self.__idle.pop()
+                if now - last_used <= self.__idle_timeout:
+                    con.timeout = timeout
+                    if con.sock is not None:
+                        con.sock.settimeout(timeout)
+                    return con, True
+                con.close()
+            self.__opened += 1
+        if self.__scheme == 'https':
+            return client.HTTPSConnection(self.__host, self.__port, timeout=timeout), False
+        return client.HTTPConnection(self.__host, self.__port, timeout=timeout), False
+
+    def put(self, con):
+        with self.__lock:
+            if len(self.__idle) < self.__maxsize:
+                self.__idle.append((con, time.time()))
+                return
+        con.close()
+
+    def clear(self):
+        with self.__lock:
+            while len(self.__idle) > 0:
+                self.__idle.pop()[0].close()
+
+
+class PoolManager:
+    """
+    Pools of connections grouped by scheme and netloc.
+    """
+
+    def __init__(self, maxsize=4, idle_timeout=60.0) -> None:
+        self.__maxsize = maxsize
+        self.__idle_timeout = idle_timeout
+        self.__pools = {}
+        self.__lock = threading.Lock()
+
+    def pool(self, scheme, netloc) -> ConnectionPool:
+        key = (scheme, netloc)
+        with self.__lock:
+            if key not in self.__pools:
+                split = parse.urlsplit('//' + netloc)
+                self.__pools[key] = ConnectionPool(scheme, split.hostname, split.port, self.__maxsize, self.__idle_timeout)
+            return self.__pools[key]
+
+    def urlopen(self, req: Request, timeout=30):
+        """
+        Same as urllib.request.urlopen() but over pooled connections.
+        Redirections are followed and HTTPError is raised if the status isn't 2xx.
+        Only http/https are supported.
+        :return: a PooledResponse which should be used as a context manager
+        """
+        method = req.get_method()
+        url, data = req.full_url, req.data
+        headers = dict(req.header_items())
+        if data is not None:
+            headers.setdefault('Content-type', 'application/x-www-form-urlencoded')
+        for i in range(MAX_REDIRECTIONS + 1):
+            r = self.__request(method, url, data, headers, timeout)
+            if r.status in REDIRECT_CODES and r.getheader('Location') is not None:
+                location = parse.urljoin(url, r.getheader('Location'))
+                r.read()
+                r.close()
+                logger.info('Redirect to %s', location)
+                url = location
+                if r.status == 303 or (r.status in (301, 302) and method == 'POST'):
+                    method, data = 'GET', None
+                    headers = dict((k, v) for k, v in headers.items() if k.lower() not in ('content-type', 'content-length'))
+                continue
+            if 200 <= r.status < 300:
+                return r
+            body = r.read()
+            r.close()
+            raise error.HTTPError(url, r.status, r.reason, r.headers, io.BytesIO(body))
+        raise error.HTTPError(url, 310, 'Too many redirections', None, None)
+
+    def clear(self):
+        with self.__lock:
+            for pool in self.__pools.values():
+                pool.clear()
+
+    def __request(self, method, url, data, headers, timeout):
+        scheme, netloc, path, query, fragment = parse.urlsplit(url)
+        pool = self.pool(scheme, netloc)
+        selector = parse.urlunsplit(('', '', path or '/', query, ''))
+        while True:
+            con, reused = pool.get(timeout)
+            try:
+                con.request(method, selector, body=data, headers=headers)
+                r = con.getresponse()
+            except (client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                con.close()
+                if reused:
+                    # the server closed an idle connection, try a new one
+                    continue
+                raise e
+            except socket.timeout as e:
+                con.close()
+                raise e
+            except OSError as e:
+                con.close()
+                raise error.URLError(e)
+            return PooledResponse(pool, con, r, url)
+
+
+class PooledResponse:
+    """
+    Wrapper of a http.client.HTTPResponse. The connection is put back to the pool when closed if the response has
+    been read completely, otherwise the connection is closed. Responses without a body, like ones of HEAD, are complete.
+    """
+
+    def __init__(self, pool: ConnectionPool, con, response: client.HTTPResponse, url) -> None:
+        self.__pool = pool
+        self.__con = con
+        self.__response = response
+        self.__url = url
+
+    @property
+    def status(self):
+        return self.__response.status
+
+    @property
+    def code(self):
+        return self.__response.status
+
+    @property
+    def reason(self):
+        return self.__response.reason
+
+    @property
+    def headers(self):
+        return self.__response.headers
+
+    @property
+    def url(self):
+        return self.__url
+
+    def geturl(self):
+        return self.__url
+
+    def getcode(self):
+        return self.__response.status
+
+    def getheader(self, name, default=None):
+        return self.__response.getheader(name, default)
+
+    def read(self, amt=None):
+        return self.__response.read(amt)
+
+    def close(self):
+        if self.__con is None:
+            return
+        con, self.__con = self.__con, None
+        if not self.__response.isclosed() and self.__response.length == 0:
+            # nothing to read, but the response isn't closed until read
+            self.__response.read()
+        if self.__response.isclosed() and not self.__response.will_close:
+            self.__pool.put(con)
+        else:
+            self.__response.close()
+            con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -6,18 +6,32 @@ Priority of the site is decided by the order the subclass is written.
 @Date 2020/4/25
 """
 import abc
+import functools
 import os
 import re
 import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib import parse, error
 from urllib.request import Request
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 
 from tools.video import Subtype
 from . import logger
+from .metrics import metrics, timed
+from .results import cached
 from .spider import BaseSite
 
+SEARCH_CACHE_TTL = 6 * 3600  # seconds
+INVALID_NAME_STRS = ['国语', '中字', '高清', 'HD', 'BD', '1280', 'DVD', '《', '》', '720p', '[', ']',
+                     '1024', '576', '*', '中英字幕', '中英双字', '无水']
+_INVALID_NAME_REGEX = re.compile('|'.join([re.escape(x) for x in INVALID_NAME_STRS]))
+_SEASON_REGEX = re.compile(r'第.{1,2}季')
+_BOOK_TITLE_REGEX = re.compile(r'《(.*)》')
+_PUNCTUATION_REGEX = re.compile(r'[\W_]+')
+_NUMBER_REGEX = re.compile(r'\d+|[零一二三四五六七八九十]+(?=[季部集])')
+SITE_DEADLINE = 120  # seconds to search or collect on a site
+
 
 def _get_possible_titles(subject) -> (str, set):
     """
@@ -53,14 +67,105 @@ def _get_possible_titles(subject) -> (str, set):
     return base_title, matches
 
 
+@functools.lru_cache(maxsize=64)
+def _build_match_index(subtype, title, original_title, aka, year, current_season):
+    key, matches = _get_possible_titles({
+        'subtype': subtype, 'title': title, 'original_title': original_title, 'aka': list(aka), 'year': year,
+        'current_season': current_season
+    })
+    return key, MatchIndex(matches)
+
+
+def match_index(subject) -> (str, 'MatchIndex'):
+    """
+    Get the key to search and the index of possible titles of the subject, which is shared by all sites.
+    """
+    return _build_match_index(subject['subtype'], subject['title'], subject['original_title'], tuple(subject['aka']),
+                              subject['year'], subject['current_season'])
+
+
+def normalize_title(title: str) -> str:
+    """
+    Lower case without spaces and punctuations, for similarity
+    """
+    return _PUNCTUATION_REGEX.sub('', title).lower()
+
+
+def _ngrams(string: str, n) -> set:
+    if len(string) <= n:
+        return {string} if string else set()
+    return set([string[i:i + n] for i in range(len(string) - n + 1)])
+
+
+def _numbers(string: str) -> frozenset:
+    """
+    Numbers telling sequels or seasons apart, excluding ones of 3+ digits like years or resolutions
+    """
+    return frozenset([x for x in _NUMBER_REGEX.findall(string) if not (x.isdigit() and len(x) > 2)])
+
+
+class MatchIndex:
+    """
+    Index of possible titles of a subject, which scores names of a resource by matching them exactly or by overlap of
+    n-grams. A similar name must contain the same numbers as the title, so that numbered sequels or other seasons aren't
+    taken as the subject. The overlap is relative to the longer one of the name and the title, so that names with extra
+    segments, like spin-offs ('复仇者联盟外传') or other cuts, score as low as names missing part of the title.
+    """
+
+    def __init__(self, titles, n=2) -> None:
+        self.__n = n
+        self.__exact = set(titles) | set([normalize_title(x) for x in titles])
+        self.__grams = []
+        for title in set([normalize_title(x) for x in titles]):
+            grams = _ngrams(title, n)
+            if len(grams) > 0:
+                self.__grams.append((grams, _numbers(title)))
+
+    def score(self, names) -> float:
+        """
+        :return: 1 if any name matches exactly, otherwise the max ratio of n-grams shared by a name and a title to
+                n-grams of the longer one, less than 1
+        """
+        best = 0.0
+        for name in names:
+            normalized = normalize_title(name)
+            if name in self.__exact or normalized in self.__exact:
+                return 1.0
+            grams, numbers = _ngrams(normalized, self.__n), _numbers(normalized)
+            for title_grams, title_numbers in self.__grams:
+                if len(grams) > 0 and numbers == title_numbers:
+                    best = max(best, len(grams & title_grams) / max(len(grams), len(title_grams)))
+        return min(best, 0.99)
+
+
+def normalize_key(key: str) -> str:
+    """
+    Normalize a searching key so that keys differing only in cases or spaces share cached results
+    """
+    return re.sub(r'\s+', ' ', key).strip().lower()
+
+
 class VideoSearch(BaseSite):
+    # part of a resource page where download urls are, the whole page is parsed if it's None
+    DOWNS_STRAINER: SoupStrainer = None
+    RESOURCES_TTL = SEARCH_CACHE_TTL  # seconds to cache resources searched by a key
+    NO_RESOURCES_TTL = 3600  # seconds to cache no resources, shorter since they may be added soon
+    DOWNS_TTL = 7 * 86400  # seconds to cache download urls of a resource
+    DETAIL_WORKERS = 4  # max pages of resources requested at the same time
+    MAX_RESOURCES = 10  # max pages of resources to get download urls from, most relevant ones first
+    MIN_SIMILARITY = 0.75  # min similarity of names of resources not matching exactly, unless strict
 
     @abc.abstractmethod
-    def __init__(self, name, domain, interval=0, priority=10, scheme='https', strict=False, use_browser=False) -> None:
-        super().__init__(name, domain, scheme=scheme, interval=interval)
+    def __init__(self, name, domain, interval=0, priority=10, scheme='https', strict=False, use_browser=False,
+                 cache_ttl=SEARCH_CACHE_TTL, deadline=SITE_DEADLINE) -> None:
+        """
+        :param deadline: seconds to wait for search() or collect() when sites are queried together
+        """
+        super().__init__(name, domain, scheme=scheme, interval=interval, cache_ttl=cache_ttl)
         self.__priority = priority
         self.__strict = strict
         self.__use_browser = use_browser
+        self.__deadline = deadline
 
     @property
     def strict(self):
@@ -71,20 +176,23 @@ class VideoSearch(BaseSite):
         # 1 with highest priority, default 10
         return self.__priority
 
+    @property
+    def deadline(self):
+        return self.__deadline
+
+    @timed
     def search(self, subject):
         logger.info('Searching: %s, for: %s', self.name, subject['title'])
-        keys, matches = _get_possible_titles(subject)
+        key, index = match_index(subject)
         resources = []
-        for key in keys:
-            try:
-                for r in self._find_resources(key, subtype=subject['subtype']):
-                    resources.append((r['name'], self._get_url(r['href'])))
-            except socket.timeout:
-                continue
-            except ConnectionResetError:
-                continue
+        try:
+            for r in self._search_resources(key, subject['subtype']):
+                resources.append((r['name'], self._get_url(r['href'])))
+        except (socket.timeout, ConnectionResetError) as e:
+            logger.error('Failed to search %s on %s: %s', key, self.name, e)
         return resources
 
+    @timed
     def collect(self, subject):
         """
         There are steps to search resources:
@@ -96,9 +204,9 @@ class VideoSearch(BaseSite):
         :return: {url: remark, ...}
         """
         logger.info('Collecting: %s, for: %s', self.name, subject['title'])
-        key, matches = _get_possible_titles(subject)
+        key, index = match_index(subject)
         exact_resources, urls = [], {}
-        resources = self._find_resources(key, subtype=subject['subtype'])
+        resources = self._search_resources(key, subject['subtype'])
         for r in resources:
             if r['href'].startswith('//'):
                 r['href'] = self._scheme + ':' + r['href']
@@ -111,28 +219,60 @@ class VideoSearch(BaseSite):
         if len(resources) == 0:
             return urls
 
-        # filter resources, keeping those matches key exactly or most similarly
+        # filter resources, keeping top ones matching key exactly or most similarly
+        scored = []
         for resource in resources:
-            names = self._parse_resource_names(resource['name'], subject['subtype'])
-            if len(matches & names) > 0:
-                logger.info('Chosen resource: %s, %s', resource['name'], resource['href'])
-                exact_resources.append(resource)
+            score = index.score(self._parse_resource_names(resource['name'], subject['subtype']))
+            if score >= 1 or (not self.strict and score >= self.MIN_SIMILARITY):
+                scored.append((score, resource))
             else:
-                logger.info('Excluded resource: %s, %s', resource['name'], resource['href'])
-
-        # get download urls from the resources
-        for resource in exact_resources:
-            if self.__use_browser:
-                soup = self.get_browser_soup(resource['href'])
-            else:
-                soup = self.get_soup(resource['href'])
-            links = self._find_downs(soup)
-            if len(links) > 0:
-                urls.update(links)
+                logger.info('Excluded resource: %.2f, %s, %s', score, resource['name'], resource['href'])
+        scored.sort(key=lambda x: x[0], reverse=True)
+        for i, (score, resource) in enumerate(scored):
+            if i < self.MAX_RESOURCES:
+                logger.info('Chosen resource: %.2f, %s, %s', score, resource['name'], resource['href'])
+                exact_resources.append(resource)
             else:
-                logger.info('No links resource: %s', resource['name'])
+                logger.info('Skipped resource: %.2f, %s, %s', score, resource['name'], resource['href'])
+
+        # get download urls from the resources concurrently, requests are still limited by the interval of the site
+        with ThreadPoolExecutor(max_workers=self.DETAIL_WORKERS, thread_name_prefix=self.name) as executor:
+            futures = dict([(executor.submit(self._get_downs, x['href']), x) for x in exact_resources])
+            for future in as_completed(futures):
+                resource = futures[future]
+                try:
+                    links = future.result()
+                except (error.URLError, socket.timeout, ConnectionResetError) as e:
+                    logger.error('Failed to get links of resource: %s, %s', resource['name'], e)
+                    continue
+                if len(links) > 0:
+                    urls.update(links)
+                else:
+                    logger.info('No links resource: %s', resource['name'])
         return urls
 
+    @cached('RESOURCES_TTL', 'NO_RESOURCES_TTL', key=lambda key, subtype: [normalize_key(key), subtype.name])
+    def _search_resources(self, key: str, subtype: Subtype) -> list:
+        """
+        Search resources by self._find_resources(), whose results are cached by the normalized key and the subtype.
+        """
+        with metrics.method(type(self).__name__, '_find_resources'):
+            return self._find_resources(key.strip(), subtype=subtype)
+
+    @timed
+    @cached('DOWNS_TTL', 'NO_RESOURCES_TTL')
+    def _get_downs(self, href) -> dict:
+        """
+        Get download urls on the page of a resource by self._find_downs(), whose results are cached by the url.
+        It's timed by itself since it runs in threads of collect(), where the method of the caller isn't tracked.
+        """
+        if self.__use_browser:
+            soup = self.get_browser_soup(href, parse_only=self.DOWNS_STRAINER)
+        else:
+            soup = self.get_soup(href, parse_only=self.DOWNS_STRAINER)
+        with metrics.method(type(self).__name__, '_find_downs'):
+            return self._find_downs(soup)
+
     def _is_subtype(self, subtype: Subtype, key, movie_keys, tv_keys, unknown_keys):
         if key in movie_keys:
             return subtype == Subtype.movie
@@ -144,25 +284,21 @@ class VideoSearch(BaseSite):
 
     @staticmethod
     def _parse_resource_names(name: str, subtype: Subtype) -> set:
-        invalid_str = ['国语', '中字', '高清', 'HD', 'BD', '1280', 'DVD', '《', '》', '720p', '[', ']',
-                       '1024', '576', '*', '中英字幕', '中英双字', '无水']
-        for s in invalid_str:
-            name = name.replace(s, '')
-        # name = re.sub(r'\[.*\]', '', name)
+        book_title = _BOOK_TITLE_REGEX.search(name)
+        name = _INVALID_NAME_REGEX.sub('', name)
         names = {name}
         if subtype == Subtype.movie:
             names.update(set([n.strip().replace('  ', '') for n in name.split('/')]))
         else:
-            season = re.search(r'第.{1,2}季', name)
+            season = _SEASON_REGEX.search(name)
             if season:
                 season_str = season[0]
                 name = name.replace(season_str, '')
             else:
                 season_str = ''
             names.update(set([n.strip() + season_str for n in name.split('/')]))
-        match = re.search(r'《(.*)》', name)
-        if match is not None:
-            names.add(match.group(1))
+        if book_title is not None:
+            names.add(_INVALID_NAME_REGEX.sub('', book_title.group(1)))
         return names
 
     @abc.abstractmethod
@@ -186,6 +322,7 @@ class VideoSearch80s(VideoSearch):
     """
     Links distribution: mostly http, few ed2k/magnet
     """
+    DOWNS_STRAINER = SoupStrainer('table')
 
     def __init__(self) -> None:
         super().__init__('80s', 'y80s.com', priority=1, scheme='http', interval=10)
@@ -193,7 +330,7 @@ class VideoSearch80s(VideoSearch):
     def _find_resources(self, key: str, subtype) -> list:
         form_data = parse.urlencode({'keyword': key}).encode(encoding='utf-8')
         req = Request(self._get_url('/search', 'm'), data=form_data, method='POST')
-        soup = self.get_soup(req)
+        soup = self.get_soup(req, parse_only=SoupStrainer('div', class_='list-group'))
         resources = []
         for mov_a in soup.find('div', class_='list-group').find_all('a', class_='list-group-item'):
             href: str = mov_a['href']
@@ -222,12 +359,13 @@ class VideoSearchXl720(VideoSearch):
     """
     Links distribution: mainly ed2k/ftp, few magnet/http/pan
     """
+    DOWNS_STRAINER = SoupStrainer('div', id=['zdownload', 'ztxt'])
 
     def __init__(self) -> None:
         super().__init__('Xl720', 'xl720.com', priority=2)
 
     def _find_resources(self, key: str, subtype: Subtype) -> list:
-        soup = self.get_soup(self._get_url('/', query_params={'s': key}))
+        soup = self.get_soup(self._get_url('/', query_params={'s': key}), parse_only=SoupStrainer('div', class_='post clearfix'))
         resources = []
         for div in soup.find_all('div', class_='post clearfix'):
             mov_a = div.find('h3').find('a', rel='bookmark')
@@ -258,13 +396,15 @@ class VideoSearchXLC(VideoSearch):
     """
     Links distribution: evenly torrent/ftp/magnet/pan/http/ed2k
     """
+    DOWNS_STRAINER = SoupStrainer('div', class_='ui-limit')
 
     def __init__(self) -> None:
         super().__init__('XLC', 'xunleicang.in', priority=3)
 
     def _find_resources(self, key: str, subtype: Subtype):
         form_data = parse.urlencode({'wd': key}).encode(encoding='utf-8')
-        soup = self.get_soup(Request(self._get_url('/vod-search'), data=form_data, method='POST'))
+        soup = self.get_soup(Request(self._get_url('/vod-search'), data=form_data, method='POST'),
+                             parse_only=SoupStrainer('div', class_='movList4'))
         resources = []
         for mov in soup.find_all('div', {'class': 'movList4'}):
             mov_a = mov.ul.li.h3.a
@@ -292,13 +432,16 @@ class VideoSearchAxj(VideoSearch):
     """
     Links distribution: mainly magnet/pan, few ed2k
     """
+    DOWNS_STRAINER = SoupStrainer('div', class_='editor_content')
+    RESOURCES_TTL = 2 * SEARCH_CACHE_TTL  # searching by the browser is slow
+    DETAIL_WORKERS = 2  # same as the default count of browsers
 
     def __init__(self) -> None:
-        super().__init__('Axj', 'aixiaoju.com', interval=15, use_browser=True)
+        super().__init__('Axj', 'aixiaoju.com', interval=15, use_browser=True, deadline=3 * SITE_DEADLINE // 2)
 
     def _find_resources(self, key: str, subtype: Subtype) -> list:
         url = self._get_url('/app-thread-run', query_params={'app': 'search', 'keywords': key, 'orderby': 'lastpost_time'})
-        soup = self.get_soup(url)
+        soup = self.get_soup(url, parse_only=SoupStrainer('div', class_='search_content'))
         resources = []
         for dl in soup.find('div', class_='search_content').find_all('dl'):
             mov_a = dl.find('dt').find('a', class_='tlink')
@@ -322,6 +465,7 @@ class VideoSearchZhandi(VideoSearch):
     """
     Links distribution: mostly ftp, partly ed2k, few magnet/http
     """
+    DOWNS_STRAINER = SoupStrainer('ul', id='downul')
 
     def __init__(self) -> None:
         super().__init__('Zhandi', 'zhandi.cc')
@@ -329,7 +473,7 @@ class VideoSearchZhandi(VideoSearch):
     def _find_resources(self, key: str, subtype: Subtype) -> list:
         form_data = parse.urlencode({'wd': key}).encode(encoding='utf-8')
         req = Request(self._get_url('/index.php', query_params={'s': 'vod-search'}), data=form_data, method='POST')
-        soup = self.get_soup(req)
+        soup = self.get_soup(req, parse_only=SoupStrainer('ul', id='contents'))
         resources = []
         for mov in soup.find('ul', {'id': 'contents'}).find_all('li'):
             mov_a = mov.h5.a
@@ -358,6 +502,7 @@ class VideoSearchHhyyk(VideoSearch):
     """
     Links distribution: mainly ftp/pan/magnet, few torrent/http
     """
+    DOWNS_STRAINER = SoupStrainer('p', class_='detail-text-p')
 
     def __init__(self) -> None:
         # todo filter by subtype
@@ -366,7 +511,7 @@ class VideoSearchHhyyk(VideoSearch):
         super().__init__('Hhyyk', 'hhyyk.com', scheme='http')
 
     def _find_resources(self, key: str, subtype: Subtype) -> list:
-        soup = self.get_soup(self._get_url('/search', query_params={'keyword': key}))
+        soup = self.get_soup(self._get_url('/search', query_params={'keyword': key}), parse_only=SoupStrainer('tbody'))
         resources = []
         tbody = soup.find('tbody')
         if tbody is not None:
@@ -390,6 +535,7 @@ class VideoSearchMP4(VideoSearch):
     """
     Links distribution: mainly ftp/ed2k/magnet, few http
     """
+    DOWNS_STRAINER = SoupStrainer('div', class_='article-related download_url')
 
     def __init__(self) -> None:
         # todo filter by subtype
@@ -398,7 +544,7 @@ class VideoSearchMP4(VideoSearch):
         super().__init__('MP4', 'domp4.com', use_browser=True)
 
     def _find_resources(self, key: str, subtype: Subtype) -> list:
-        soup = self.get_soup(self._get_url('/search/%s.html' % parse.quote(key)))
+        soup = self.get_soup(self._get_url('/search/%s.html' % parse.quote(key)), parse_only=SoupStrainer('div', id='list_all'))
         resources = []
         for li in soup.find('div', id='list_all').find('ul').find_all('li'):
             h2 = li.find('h2')
@@ -423,6 +569,7 @@ class SrtSearchSsk(VideoSearch):
     """
     Search srt resources from <https://sskzmz.com/>.
     """
+    DOWNS_STRAINER = SoupStrainer('tbody')
 
     def __init__(self) -> None:
         import warnings
@@ -430,7 +577,7 @@ class SrtSearchSsk(VideoSearch):
         super().__init__('Ssk', 'sskzmz.com')
 
     def _find_resources(self, key: str, subtype: Subtype) -> list:
-        soup = self.get_soup(self._get_url('/index/search', {'tab': key}))
+        soup = self.get_soup(self._get_url('/index/search', {'tab': key}), parse_only=SoupStrainer('div', class_='row movie'))
         resources = []
         for mov in soup.find('div', {'class': 'row movie'}).find_all('div'):
             mov_a = mov.a
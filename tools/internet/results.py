@@ -0,0 +1,145 @@
+""" Caches of results of site methods
+
+Parsed results are cached, instead of responses, so that hits cost neither requests nor parsing. Results are kept in
+memory and optionally in a SQLite database to survive restarts. They are stored as json, so only json-serializable
+results can be cached.
+
+@Author Kingen
+@Date 2020/6/10
+"""
+import functools
+import inspect
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .cassette import get_cassette
+from .metrics import metrics
+
+_results = None
+_lock = threading.Lock()
+
+
+class ResultCache:
+    def __init__(self, db_path=None, max_entries=1024) -> None:
+        """
+        :param db_path: database to persist results, results are kept in memory only if it's None
+        :param max_entries: max results kept in memory, least recently used ones are dropped first
+        """
+        self.__db = db_path
+        self.__max_entries = max_entries
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        if db_path is not None:
+            with sqlite3.connect(db_path) as con:
+                con.execute('CREATE TABLE IF NOT EXISTS result_cache(namespace TEXT NOT NULL, key TEXT NOT NULL, '
+                            'value TEXT NOT NULL, stored REAL NOT NULL, PRIMARY KEY (namespace, key))')
+
+    def get(self, namespace, key, ttl):
+        """
+        :param ttl: seconds, or a function to get seconds by the result
+        :return: (whether found, the result)
+        """
+        with self.__lock:
+            entry = self.__entries.get((namespace, key))
+            if entry is not None:
+                self.__entries.move_to_end((namespace, key))
+        if entry is None and self.__db is not None:
+            with sqlite3.connect(self.__db, timeout=30) as con:
+                entry = con.execute('SELECT value, stored FROM result_cache WHERE namespace = ? AND key = ?',
+                                    (namespace, key)).fetchone()
+            if entry is not None:
+                self.__remember(namespace, key, entry)
+        if entry is None:
+            return False, None
+        result = json.loads(entry[0])
+        if time.time() - entry[1] >= (ttl(result) if callable(ttl) else ttl):
+            return False, None
+        return True, result
+
+    def set(self, namespace, key, value):
+        entry = (json.dumps(value, ensure_ascii=False), time.time())
+        self.__remember(namespace, key, entry)
+        if self.__db is not None:
+            with sqlite3.connect(self.__db, timeout=30) as con:
+                con.execute('INSERT OR REPLACE INTO result_cache(namespace, key, value, stored) VALUES (?, ?, ?, ?)',
+                            (namespace, key) + entry)
+
+    def delete(self, namespace, key):
+        with self.__lock:
+            self.__entries.pop((namespace, key), None)
+        if self.__db is not None:
+            with sqlite3.connect(self.__db, timeout=30) as con:
+                con.execute('DELETE FROM result_cache WHERE namespace = ? AND key = ?', (namespace, key))
+
+    def __remember(self, namespace, key, entry):
+        with self.__lock:
+            self.__entries[(namespace, key)] = entry
+            self.__entries.move_to_end((namespace, key))
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+
+
+def init_results(db_path=None, max_entries=1024):
+    """
+    Set where to cache results of site methods. They are kept in memory of current process if db_path is None.
+    """
+    global _results
+    with _lock:
+        _results = ResultCache(db_path, max_entries)
+
+
+def get_results() -> ResultCache:
+    global _results
+    with _lock:
+        if _results is None:
+            _results = ResultCache()
+        return _results
+
+
+def cached(ttl, empty_ttl=None, key=None):
+    """
+    Decorator to cache results of a method of a site by its arguments for ttl seconds.
+    Hits and misses are counted as 'result_hits' and 'result_misses' of the method.
+    The cache is bypassed when a cassette is recording or replaying.
+    :param ttl: seconds, or name of an attribute of the site holding the seconds
+    :param empty_ttl: seconds to cache empty results, like ttl, same as ttl if it's None
+    :param key: function to get a json-serializable key from arguments of the method, excluding the site,
+            arguments are used by default
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            site = type(self).__name__
+            seconds = getattr(self, ttl) if isinstance(ttl, str) else ttl
+            empty_seconds = seconds if empty_ttl is None else getattr(self, empty_ttl) if isinstance(empty_ttl, str) else empty_ttl
+            namespace = '%s.%s' % (site, func.__name__)
+            if key is not None:
+                cache_key = json.dumps(key(*args, **kwargs), ensure_ascii=False)
+            else:
+                # defaults are applied so that the same call with or without them shares a result
+                arguments = signature.bind(self, *args, **kwargs)
+                arguments.apply_defaults()
+                cache_key = json.dumps(list(arguments.arguments.items())[1:], ensure_ascii=False)
+            cassette = get_cassette()
+            if cassette is not None:
+                # requests are recorded or replayed by the cassette, which results from the cache would skip
+                return func(self, *args, **kwargs)
+            results = get_results()
+            found, result = results.get(namespace, cache_key, lambda x: seconds if x else empty_seconds)
+            if found:
+                metrics.count(site, 'result_hits', method=func.__name__)
+                return result
+            metrics.count(site, 'result_misses', method=func.__name__)
+            result = func(self, *args, **kwargs)
+            results.set(namespace, cache_key, result)
+            return result
+
+        return wrapper
+
+    return decorator
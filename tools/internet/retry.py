@@ -0,0 +1,99 @@
+""" Policies to retry failed requests
+
+Waits grow exponentially with full jitter and are capped. 'Retry-After' of 429/503 responses is respected.
+A budget limits total retries of a crawl so that a flaky site can't stall the whole crawl.
+
+@Author Kingen
+@Date 2020/6/6
+"""
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+RETRY_STATUSES = (429, 503)
+
+
+class RetryBudget:
+    """
+    Total count of retries allowed, shared by all requests using it.
+    """
+
+    def __init__(self, total) -> None:
+        self.__remaining = total
+        self.__lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        return self.__remaining
+
+    def consume(self) -> bool:
+        """
+        Take a retry from the budget
+        :return: False if the budget is used up
+        """
+        with self.__lock:
+            if self.__remaining <= 0:
+                return False
+            self.__remaining -= 1
+            return True
+
+
+class RetryPolicy:
+    def __init__(self, retries=3, base=1.0, cap=60.0, jitter=True, budget: RetryBudget = None) -> None:
+        """
+        :param retries: max retries of a request
+        :param base: seconds to wait before first retry
+        :param cap: max seconds to wait, including the time specified by 'Retry-After'
+        :param jitter: whether to randomize waits to spread retries of concurrent requests
+        :param budget: shared budget of retries, unlimited if it's None
+        """
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.jitter = jitter
+        self.budget = budget
+
+    def allow(self, attempt, retries=None) -> bool:
+        """
+        :param attempt: count of retries done
+        :param retries: max retries instead of self.retries
+        """
+        if retries is None:
+            retries = self.retries
+        return attempt < retries and (self.budget is None or self.budget.consume())
+
+    def backoff(self, attempt, retry_after=None) -> float:
+        """
+        :param retry_after: seconds specified by the server
+        :return: seconds to wait before next retry
+        """
+        if retry_after is not None:
+            return min(self.cap, retry_after)
+        delay = min(self.cap, self.base * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def with_budget(self, budget: RetryBudget):
+        """
+        :return: a copy of this policy using the budget
+        """
+        return RetryPolicy(self.retries, self.base, self.cap, self.jitter, budget)
+
+
+def parse_retry_after(headers):
+    """
+    :param headers: headers of the response, may be None
+    :return: seconds to wait specified by 'Retry-After', or None if it's not specified
+    """
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -3,83 +3,270 @@
 @Author Kingen
 @Date 2020/4/13
 """
+import re
 import socket
 import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http.client import HTTPException, responses
 from urllib import parse, error
 from urllib.request import Request, urlopen
 
-from bs4 import BeautifulSoup
-from selenium import webdriver
+from bs4 import BeautifulSoup, SoupStrainer
 
 from . import logger
+from .browser import get_browsers
+from .cache import CacheEntry, cache_key, get_cache
+from .cassette import get_cassette
+from .flight import SingleFlight
+from .limiter import get_bucket
+from .metrics import metrics
+from .pool import PoolManager
+from .retry import RetryPolicy, RetryBudget, RETRY_STATUSES, parse_retry_after
 
 BASE_HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/80.0.3987.132 Safari/537.36'
 }
 
+try:
+    import lxml
 
-def pre_download(url, pause=0.0, timeout=30, retry=3):
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+try:
+    import brotli
+
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    brotli = None
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+CHARSET_REGEX = re.compile(r'charset\s*=\s*["\']?([\w-]+)', re.I)
+META_CHARSET_REGEX = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([\w-]+)', re.I)
+# charsets whose supersets are used by sites in practice
+CHARSET_SUPERSETS = {'gb2312': 'gb18030', 'gbk': 'gb18030', 'iso-8859-1': 'cp1252'}
+
+# shared by requests which don't belong to any site
+default_pools = PoolManager()
+default_policy = RetryPolicy()
+
+# requests in flight of all sites
+_flights = SingleFlight()
+
+
+def urlopen_pooled(req: Request, timeout=30, pools: PoolManager = None):
+    """
+    Open the request over persistent connections if it's http/https, otherwise by urllib.
+    """
+    if req.type not in ('http', 'https'):
+        return urlopen(req, timeout=timeout)
+    if pools is None:
+        pools = default_pools
+    return pools.urlopen(req, timeout=timeout)
+
+
+def pre_download(url, pause=0.0, timeout=30, retry=None, pools: PoolManager = None, policy: RetryPolicy = None):
     """
     Do Pre-request a download url
     Get info of response, Content-Length or file size mainly.
+    :param retry: max retries, retries of the policy by default
+    :param pools: pools of connections to request over, default_pools by default
+    :param policy: policy to retry, default_policy by default
     :return: (code, msg, args). Optional code and msg: (200, 'OK')/(1, 'Unknown Content Length')/(408, 'Timeout')
             'args', a dict of info will be returned if code is 200: size(B)
     """
     if pause > 0:
         time.sleep(pause)
-    req = Request(quote_url(url), headers=BASE_HEADERS, method='GET')
-    timeout_count = reset_count = no_response_count = refused_count = 0
+    info = probe(url, timeout, retry, pools, policy)
+    if info['code'] != 200:
+        return info['code'], info['msg'], None
+    if info['size'] is None:
+        logger.error('Unknown Content Length')
+        return 1, 'Unknown Content Length', None
+    return 200, 'OK', {'size': info['size']}
+
+
+def probe_all(urls, workers=8, timeout=30, retry=None, pools: PoolManager = None, policy: RetryPolicy = None) -> list:
+    """
+    Probe download urls concurrently
+    :param workers: max count of urls probed at the same time
+    :return: list of results of probe() in the order of urls. Code is -1 if an unknown error occurs.
+    """
+
+    def safe_probe(url):
+        try:
+            return probe(url, timeout, retry, pools, policy)
+        except (OSError, HTTPException) as e:
+            logger.error('Failed to probe %s: %s', url, e)
+            return {'url': url, 'code': -1, 'msg': str(e), 'size': None, 'ranges': False, 'type': None, 'final_url': url}
+
+    urls = list(urls)
+    if len(urls) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as executor:
+        return list(executor.map(safe_probe, urls))
+
+
+def probe(url, timeout=30, retry=None, pools: PoolManager = None, policy: RetryPolicy = None) -> dict:
+    """
+    Probe a download url by a HEAD request, or a ranged GET of the first byte if HEAD isn't supported.
+    :return: {'url': url, 'code': code, 'msg': msg, 'size': size(B) or None if unknown,
+                'ranges': whether Range is supported, 'type': Content-Type, 'final_url': url after redirections}.
+            Optional code and msg: (200, 'OK')/(408, 'Timeout')/(code, reason) of HTTPError or URLError
+    """
+    cassette = get_cassette()
+    if cassette is not None and cassette.replaying:
+        return cassette.replay_probe(url)
+    info = _probe(url, timeout, retry, pools, policy)
+    if cassette is not None and cassette.recording:
+        cassette.record_probe(url, info)
+    return info
+
+
+def _probe(url, timeout, retry, pools, policy):
+    if policy is None:
+        policy = default_policy
+    attempt = 0
     while True:
+        code, msg = None, None
         try:
-            logger.info('Pre-GET from %s', req.full_url)
-            with urlopen(req, timeout=timeout) as r:
-                size = r.getheader('Content-Length')
-                if size is None:
-                    logger.error('Unknown Content Length')
-                    return 1, 'Unknown Content Length', None
-                else:
-                    return 200, 'OK', {'size': int(size)}
+            info = {'url': url, 'code': 200, 'msg': 'OK'}
+            info.update(_probe_once(quote_url(url), timeout, pools))
+            return info
         except socket.timeout:
             logger.error('Timeout')
-            if timeout_count >= retry:
-                return 408, 'Timeout', None
-            timeout_count += 1
-            logger.info('Retry...')
-            time.sleep(timeout)
+            if not policy.allow(attempt, retry):
+                code, msg = 408, 'Timeout'
+            else:
+                delay = policy.backoff(attempt)
         except error.HTTPError as e:
             logger.error(e)
-            return e.code, e.reason, None
+            if e.code not in RETRY_STATUSES or not policy.allow(attempt, retry):
+                code, msg = e.code, e.reason
+            else:
+                delay = policy.backoff(attempt, parse_retry_after(e.headers))
         except error.URLError as e:
             logger.error(e)
             if e.errno is not None:
-                return e.errno, e.strerror, None
-            if e.reason is not None:
-                e = e.reason
-                if isinstance(e, socket.gaierror):
-                    return e.errno, e.strerror, None
-                if isinstance(e, TimeoutError):
-                    if no_response_count >= retry:
-                        return e.errno, e.strerror, None
-                    no_response_count += 1
-                    logger.info('Retry...')
-                    time.sleep(timeout)
-                    continue
-                if isinstance(e, ConnectionRefusedError):
-                    if refused_count >= retry:
-                        return e.errno, e.strerror, None
-                    refused_count += 1
-                    logger.info('Retry...')
-                    time.sleep(timeout)
-                    continue
-            logger.error('Unknown error')
-            raise e
+                code, msg = e.errno, e.strerror
+            elif e.reason is None:
+                logger.error('Unknown error')
+                raise e
+            elif not isinstance(e.reason, BaseException):
+                # like errors of ftp, whose reasons are strings
+                code, msg = -1, str(e.reason)
+            else:
+                reason = e.reason
+                if isinstance(reason, socket.gaierror):
+                    code, msg = reason.errno, reason.strerror
+                elif not isinstance(reason, (TimeoutError, ConnectionRefusedError)):
+                    logger.error('Unknown error')
+                    raise e
+                elif not policy.allow(attempt, retry):
+                    code, msg = reason.errno, reason.strerror
+                else:
+                    delay = policy.backoff(attempt)
         except ConnectionResetError as e:
             logger.error(e)
-            if reset_count >= retry:
-                return e.errno, e.strerror, None
-            reset_count += 1
-            logger.info('Retry...')
-            time.sleep(timeout)
+            if not policy.allow(attempt, retry):
+                code, msg = e.errno, e.strerror
+            else:
+                delay = policy.backoff(attempt)
+        if code is not None:
+            return {'url': url, 'code': code, 'msg': msg, 'size': None, 'ranges': False, 'type': None, 'final_url': url}
+        attempt += 1
+        logger.info('Retry in %.2fs...', delay)
+        time.sleep(delay)
+
+
+def _probe_once(url, timeout, pools):
+    req = Request(url, headers=BASE_HEADERS, method='HEAD')
+    if req.type not in ('http', 'https'):
+        # only GET is supported by protocols like ftp
+        logger.info('Pre-GET from %s', url)
+        with urlopen(Request(url, headers=BASE_HEADERS, method='GET'), timeout=timeout) as r:
+            return _probe_info(r)
+    try:
+        logger.info('HEAD from %s', url)
+        with urlopen_pooled(req, timeout, pools) as r:
+            info = _probe_info(r)
+        if info['size'] is not None:
+            return info
+    except error.HTTPError as e:
+        if e.code not in (403, 405, 501):
+            raise e
+        logger.info('HEAD not allowed: %d', e.code)
+    logger.info('Ranged GET from %s', url)
+    req = Request(url, headers={'Range': 'bytes=0-0', **BASE_HEADERS}, method='GET')
+    with urlopen_pooled(req, timeout, pools) as r:
+        info = _probe_info(r)
+        if r.getcode() == 206:
+            # read the only byte to keep the connection alive
+            r.read()
+    return info
+
+
+def _probe_info(r) -> dict:
+    """
+    Read info of a download from headers of the response
+    """
+    headers = r.headers
+    size, ranges = None, headers.get('Accept-Ranges', '').lower() == 'bytes'
+    match = re.fullmatch(r'bytes \d+-\d+/(\d+)', headers.get('Content-Range', '').strip())
+    if match is not None:
+        size, ranges = int(match.group(1)), True
+    elif r.getcode() != 206 and headers.get('Content-Length') is not None:
+        size = int(headers.get('Content-Length'))
+    return {'size': size, 'ranges': ranges, 'type': headers.get('Content-Type'), 'final_url': r.geturl()}
+
+
+def decompress(body: bytes, encoding=None) -> bytes:
+    """
+    Decompress the body by Content-Encoding of the response
+    :param encoding: value of Content-Encoding, may be multiple encodings applied in order
+    """
+    if encoding is None:
+        return body
+    for coding in reversed([x.strip().lower() for x in encoding.split(',')]):
+        if coding == 'gzip' or coding == 'x-gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif coding == 'deflate':
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                # raw deflate stream without zlib header
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        elif coding == 'br' and brotli is not None:
+            body = brotli.decompress(body)
+        elif coding != 'identity':
+            raise ValueError('Unsupported Content-Encoding: %s' % coding)
+    return body
+
+
+def decode_content(body: bytes, content_type=None) -> str:
+    """
+    Decode the body with the charset specified by Content-Type, or by <meta> of the page, or utf-8 by default.
+    """
+    charset = None
+    if content_type is not None:
+        match = CHARSET_REGEX.search(content_type)
+        if match is not None:
+            charset = match.group(1)
+    if charset is None:
+        match = META_CHARSET_REGEX.search(body[:2048])
+        if match is not None:
+            charset = match.group(1).decode('ascii')
+    if charset is None:
+        charset = 'utf-8'
+    charset = CHARSET_SUPERSETS.get(charset.lower(), charset)
+    try:
+        return body.decode(charset, errors='replace')
+    except LookupError:
+        logger.warning('Unknown charset: %s', charset)
+        return body.decode('utf-8', errors='replace')
 
 
 def quote_url(url: str) -> str:
@@ -91,25 +278,36 @@ def quote_url(url: str) -> str:
 
 
 class BaseSite:
-    def __init__(self, name, domain, scheme='https', headers=None, timeout=30, interval=0) -> None:
+    def __init__(self, name, domain, scheme='https', headers=None, timeout=30, interval=0, pool_size=4, idle_timeout=60.0,
+                 burst=1, cache_ttl=0, retry_policy: RetryPolicy = None, parser=PARSER) -> None:
         """
         :param name: name of the site
         :param domain: top-level domain of the site, like 'google.com'
         :param scheme: scheme of the site, generally http/https
         :param headers: headers for request
         :param timeout:
-        :param interval: interval to do next request
+        :param interval: average interval to do next request, kept by all sites of the same domain
+        :param pool_size: max count of idle connections kept alive for each host of the site
+        :param idle_timeout: seconds an idle connection is kept alive
+        :param burst: max count of requests done without waiting for the interval
+        :param cache_ttl: seconds to cache responses of the site, not cached if it's 0
+        :param retry_policy: policy to retry failed requests, default_policy by default
+        :param parser: parser of BeautifulSoup, lxml if installed
         """
         self.__name = name
         self._scheme = scheme
         self.__domain = domain
-        self.__headers = BASE_HEADERS
+        self.__headers = BASE_HEADERS.copy()
+        self.__headers['Accept-Encoding'] = ACCEPT_ENCODING
         if headers is not None:
             self.__headers.update(headers)
         self.__timeout = timeout
         self.__interval = interval
-        self.__last_access = 0.0
-        self.__chrome = webdriver.Chrome(executable_path='chromedriver 81.0.4044.138.exe')
+        self.__burst = burst
+        self.__cache_ttl = cache_ttl
+        self.retry_policy = retry_policy if retry_policy is not None else default_policy
+        self.__parser = parser
+        self.__pools = PoolManager(pool_size, idle_timeout)
 
     @property
     def name(self):
@@ -119,70 +317,176 @@ class BaseSite:
     def home(self):
         return self._scheme + '://' + self.__domain + '/'
 
-    def get_soup(self, req) -> BeautifulSoup:
+    @contextmanager
+    def retry_budget(self, total):
+        """
+        Limit total retries of requests of the site within the context, like a crawl.
+        """
+        policy = self.retry_policy
+        self.retry_policy = policy.with_budget(RetryBudget(total))
+        try:
+            yield self.retry_policy.budget
+        finally:
+            self.retry_policy = policy
+
+    def get_soup(self, req, ttl=None, parse_only: SoupStrainer = None) -> BeautifulSoup:
         """
         Request and return a soup of the page
+        :param parse_only: parse only the part of the page matched, the whole page by default
         """
-        return BeautifulSoup(self.do_request(req), 'html.parser')
+        return self._parse(self.do_request(req, ttl=ttl), parse_only)
+
+    def get_browser_soup(self, url, func=None, parse_only: SoupStrainer = None) -> BeautifulSoup:
+        return self._parse(self.browser(url, func), parse_only)
 
-    def get_browser_soup(self, url, func=None) -> BeautifulSoup:
-        return BeautifulSoup(self.browser(url, func), 'html.parser')
+    def _parse(self, markup, parse_only: SoupStrainer = None) -> BeautifulSoup:
+        with metrics.timer(type(self).__name__, 'parse'):
+            return BeautifulSoup(markup, self.__parser, parse_only=parse_only)
 
-    def do_request(self, req, retry=3):
+    def do_request(self, req, retry=None, ttl=None):
         """
         do request
+        A fresh cached response is returned directly without waiting for the interval.
         :param req: an instance of request.Request or a url
+        :param retry: max retries, retries of the retry policy by default
+        :param ttl: seconds to cache the response, cache_ttl of the site by default
         :return: content of response
         """
+        req = self.__prepare(req)
+        # concurrent callers requesting the same share one request
+        return _flights.do(cache_key(req.get_method(), req.full_url, req.data), self.__do_request, req, retry, ttl)
+
+    def __do_request(self, req: Request, retry=None, ttl=None):
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            return self.__replay(req)
+        key, entry, fresh = self.__lookup(req, ttl)
+        if fresh:
+            metrics.count(type(self).__name__, 'cache_hits')
+            # a cached response is recorded too, or it will be missing when replayed
+            self.__record(req, entry)
+            return decode_content(entry.body, entry.headers.get('content-type'))
         self.__next_access()
+        return self.__request(req, retry, key, entry)
+
+    def __prepare(self, req) -> Request:
         if isinstance(req, str):
             req = Request(req, headers=self.__headers, method='GET')
         req.headers.update(self.__headers)
+        return req
+
+    def __lookup(self, req: Request, ttl=None):
+        """
+        Look up the response of the request in the cache
+        :return: (key, cached entry, whether the entry is fresh). The key is None if the response isn't to cache.
+        """
+        cache = get_cache()
+        if ttl is None:
+            ttl = self.__cache_ttl
+        if cache is None or ttl <= 0:
+            return None, None, False
+        key = cache_key(req.get_method(), req.full_url, req.data)
+        entry = cache.get(key)
+        if entry is None:
+            return key, None, False
+        if entry.is_fresh(ttl):
+            logger.info('Hit cache of %s', req.full_url)
+            return key, entry, True
+        return key, entry, False
+
+    def __request(self, req: Request, retry=None, key=None, entry: CacheEntry = None):
+        """
+        Request and cache the response if the key is specified.
+        The stale entry is revalidated with its validators.
+        """
         logger.info('%s from %s', req.method, req.full_url)
         if req.get_method().upper() == 'POST' and req.data is not None:
             logger.info('Query: ' + parse.unquote(req.data.decode('utf=8')))
-        timeout_count = reset_count = 0
+        if entry is not None:
+            for k, v in entry.validators().items():
+                req.add_header(k, v)
+        policy = self.retry_policy
+        site, attempt = type(self).__name__, 0
         while True:
+            start = time.time()
             try:
-                with urlopen(req, timeout=self.__timeout) as r:
-                    return r.read().decode('utf-8')
-            except socket.timeout as e:
-                logger.error('Timeout!')
-                if timeout_count >= retry:
-                    raise e
-                timeout_count += 1
-                logger.info('Retry...')
-                time.sleep(self.__timeout)
+                with urlopen_pooled(req, self.__timeout, self.__pools) as r:
+                    raw = r.read()
+                    metrics.observe(site, 'request', time.time() - start)
+                    metrics.count(site, 'bytes', len(raw))
+                    body = decompress(raw, r.getheader('Content-Encoding'))
+                    headers = dict((k.lower(), v) for k, v in r.headers.items() if k.lower() != 'content-encoding')
+                    if key is not None:
+                        get_cache().set(key, CacheEntry(body, headers))
+                    self.__record(req, CacheEntry(body, headers))
+                    return decode_content(body, headers.get('content-type'))
             except error.HTTPError as e:
+                metrics.observe(site, 'request', time.time() - start)
+                if e.code == 304 and entry is not None:
+                    logger.info('Not modified: %s', req.full_url)
+                    metrics.count(site, 'not_modified')
+                    get_cache().set(key, CacheEntry(entry.body, entry.headers))
+                    self.__record(req, entry)
+                    return decode_content(entry.body, entry.headers.get('content-type'))
                 logger.error(e)
-                raise e
-            except error.URLError as e:
-                logger.error(e)
-                if timeout_count >= retry:
+                metrics.count(site, 'request_errors')
+                if e.code not in RETRY_STATUSES or not policy.allow(attempt, retry):
+                    headers = dict((k.lower(), v) for k, v in e.headers.items()) if e.headers is not None else {}
+                    self.__record(req, CacheEntry(b'', headers, status=e.code))
                     raise e
-                timeout_count += 1
-                logger.info('Retry...')
-                time.sleep(self.__timeout)
-            except ConnectionResetError as e:
+                delay = policy.backoff(attempt, parse_retry_after(e.headers))
+            except (socket.timeout, error.URLError, ConnectionResetError) as e:
                 logger.error(e)
-                if reset_count >= retry:
+                metrics.count(site, 'request_errors')
+                if not policy.allow(attempt, retry):
                     raise e
-                reset_count += 1
-                logger.info('Retry...')
-                time.sleep(self.__timeout)
+                delay = policy.backoff(attempt)
+            attempt += 1
+            metrics.count(site, 'retries')
+            logger.info('Retry in %.2fs...', delay)
+            time.sleep(delay)
+
+    @staticmethod
+    def __record(req: Request, entry: CacheEntry):
+        cassette = get_cassette()
+        if cassette is not None and cassette.recording:
+            cassette.record_response(req.get_method(), req.full_url, req.data, entry)
+
+    @staticmethod
+    def __replay(req: Request):
+        """
+        Replay the recorded response of the request
+        :raise HTTPError if the recorded status isn't 2xx
+        """
+        entry = get_cassette().replay_response(req.get_method(), req.full_url, req.data)
+        if entry.status >= 300:
+            raise error.HTTPError(req.full_url, entry.status, responses.get(entry.status, ''), entry.headers, None)
+        return decode_content(entry.body, entry.headers.get('content-type'))
+
+    def pre_download(self, url, pause=0.0, retry=None):
+        """
+        Pre-request a download url over connections of this site.
+        """
+        return pre_download(url, pause, self.__timeout, retry, self.__pools, self.retry_policy)
 
     def browser(self, url, func=None):
         """
-        simulate browser
+        simulate browser with a shared headless Chrome, started when first used
         :param url:
-        :param func: function for extra operations with a WebDriver as the argument
+        :param func: function for extra operations with a WebDriver as the argument, not called when replaying
         :return:
         """
         logger.info('Get from %s: %s', self.name, url)
-        self.__chrome.get(url)
-        if func is not None:
-            func(self.__chrome)
-        source = self.__chrome.page_source
+        cassette = get_cassette()
+        if cassette is not None and cassette.replaying:
+            return cassette.replay_page(url)
+        with get_browsers().driver() as chrome, metrics.timer(type(self).__name__, 'browser'):
+            chrome.get(url)
+            if func is not None:
+                func(chrome)
+            source = chrome.page_source
+        if cassette is not None and cassette.recording:
+            cassette.record_page(url, source)
         return source
 
     def _get_url(self, path, low_domain='', path_params=None, query_params=None) -> str:
@@ -196,16 +500,19 @@ class BaseSite:
             low_domain = low_domain + '.'
         return parse.urlunsplit((self._scheme, low_domain + self.__domain, path, query, None))
 
-    def __next_access(self, interval=0):
+    def __next_access(self):
         """
         Wait for next available access
-        :param interval: interval between two accesses
-        :return:
         """
-        if interval == 0:
-            interval = self.__interval
-        waiting = interval - time.time() + self.__last_access
+        waiting = self.__reserve_access()
+        metrics.observe(type(self).__name__, 'wait', waiting)
         if waiting > 0:
             logger.info('Waiting for %.2fs', waiting)
             time.sleep(waiting)
-        self.__last_access = time.time()
+
+    def __reserve_access(self):
+        """
+        Reserve next available access from the bucket of the domain so that concurrent callers queue up
+        :return: seconds to wait before the access
+        """
+        return get_bucket(self.__domain, self.__interval, self.__burst).reserve()
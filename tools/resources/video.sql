@@ -21,3 +21,13 @@ CREATE TABLE IF NOT EXISTS movie
     source         TEXT,
     last_update    TEXT     NOT NULL
 );
+
+CREATE TABLE IF NOT EXISTS sync_state
+(
+    user_id     INTEGER NOT NULL,
+    category    TEXT    NOT NULL, -- wish/do/collect
+    tag_date    TEXT    NOT NULL, -- tag_date of the latest subject synced
+    subject_id  INTEGER NOT NULL, -- id of the latest subject synced
+    last_update TEXT    NOT NULL,
+    PRIMARY KEY (user_id, category)
+);
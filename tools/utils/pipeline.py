@@ -0,0 +1,114 @@
+""" Pipeline of stages running concurrently
+
+Each stage has its own workers and a bounded queue of items waiting for it, so that a slow stage applies back
+pressure to the ones before it instead of piling up items. Results are consumed in the calling thread, where
+resources bound to the thread (like sqlite connections) can be used.
+
+@Author Kingen
+@Date 2020/6/10
+"""
+import threading
+from queue import Queue, Empty, Full
+
+from . import logger
+
+_END = object()
+
+
+class Stage:
+    def __init__(self, name, func, workers=1, queue_size=16) -> None:
+        """
+        :param func: function to process an item, returning the item for next stage
+        :param workers: count of threads running the function
+        :param queue_size: max count of items waiting for the stage
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue_size = queue_size
+
+
+class Failure:
+    def __init__(self, item, stage, error) -> None:
+        """
+        :param item: original item put into the pipeline
+        :param stage: name of the stage where it failed
+        """
+        self.item = item
+        self.stage = stage
+        self.error = error
+
+    def __repr__(self) -> str:
+        return 'Failure(%r at %s: %r)' % (self.item, self.stage, self.error)
+
+
+def run_pipeline(items, *stages: Stage, out_size=16):
+    """
+    Pass items through the stages. Failures of items don't stop the pipeline.
+    Closing the generator stops feeding and processing items.
+    :return: generator of (original item, result of last stage or None, Failure or None), in the order of completion
+    """
+    stopped = threading.Event()
+    queues = [Queue(maxsize=x.queue_size) for x in stages] + [Queue(maxsize=out_size)]
+
+    def put(q, value):
+        while not stopped.is_set():
+            try:
+                q.put(value, timeout=0.5)
+                return
+            except Full:
+                pass
+
+    def feed():
+        for item in items:
+            if stopped.is_set():
+                break
+            put(queues[0], (item, item))
+        put(queues[0], _END)
+
+    def work(index, stage: Stage, remaining: list, lock):
+        src, dst = queues[index], queues[index + 1]
+        while not stopped.is_set():
+            try:
+                value = src.get(timeout=0.5)
+            except Empty:
+                continue
+            if value is _END:
+                # let other workers of the stage see the end too
+                put(src, _END)
+                break
+            item, data = value
+            if isinstance(data, Failure):
+                put(dst, value)
+                continue
+            try:
+                data = stage.func(data)
+            except Exception as e:
+                logger.error('Failed at stage %s: %r, %s', stage.name, item, e)
+                data = Failure(item, stage.name, e)
+            put(dst, (item, data))
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                put(dst, _END)
+
+    threads = [threading.Thread(target=feed, name='pipeline-feed', daemon=True)]
+    for i, stage in enumerate(stages):
+        remaining, lock = [stage.workers], threading.Lock()
+        for j in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(i, stage, remaining, lock),
+                                            name='pipeline-%s-%d' % (stage.name, j), daemon=True))
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            value = queues[-1].get()
+            if value is _END:
+                break
+            item, data = value
+            if isinstance(data, Failure):
+                yield item, None, data
+            else:
+                yield item, data, None
+    finally:
+        stopped.set()
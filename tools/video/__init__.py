@@ -3,16 +3,22 @@
 @Author Kingen
 @Date 2020/5/12
 """
+import json
 import logging
 import re
 from urllib import error
 
-from flask import Blueprint, request, render_template, g
+from flask import Blueprint, request, render_template, g, current_app, Response, stream_with_context
 from flask_cors import cross_origin
 
+from tools.internet.browser import init_browsers
+from tools.internet.cache import init_cache, FileCache
+from tools.internet.cassette import init_cassette
+from tools.internet.limiter import init_limiter
+from tools.internet.results import init_results
 from tools.utils.common import success, fail, read_config_from_py_file
 from .enums import Status, Archived, Subtype
-from .manager import VideoManager
+from .manager import VideoManager, init_video_db
 
 config = None
 
@@ -61,12 +67,48 @@ def archive():
 @video_blu.route('/search')
 def search():
     key = request.args.get('id', type=int)
+    if key is None:
+        key = request.args.get('key', type=str)
     if key:
-        return render_template('search.jinja2', resources=manager().search_resources(key))
-    key = request.args.get('key', type=str)
-    if key:
-        return render_template('search.jinja2', resources=manager().search_resources(key))
-    return render_template('search.jinja2')
+        resources, partial = manager().search_resources(key)
+        return render_template('search.jinja2', resources=resources, partial=partial)
+    return render_template('search.jinja2', resources={}, partial={})
+
+
+@video_blu.route('/search/stream')
+def search_stream():
+    """
+    Render resources of each site as soon as the site finishes.
+    """
+    resources = manager().iter_search_resources(request.args.get('id', type=int))
+    template = current_app.jinja_env.get_template('search_stream.jinja2')
+    return Response(stream_with_context(template.stream(resources=resources)), mimetype='text/html')
+
+
+@video_blu.route('/search/events')
+def search_events():
+    """
+    Server-Sent Events of resources for scripted clients.
+    A 'site' event is sent for each site as soon as it finishes, with json data:
+        {"site": name, "home": url, "priority": int, "resources": [{"name": name, "url": url},...], "error": msg or null}
+    An 'end' event with json data {"count": count of sites} is sent at last.
+    """
+    resources = manager().iter_search_resources(request.args.get('id', type=int))
+
+    def generate():
+        count = 0
+        for site, rs, e in resources:
+            count += 1
+            yield sse_event('site', {
+                'site': site.name,
+                'home': site.home,
+                'priority': site.priority,
+                'resources': [{'name': name, 'url': url} for name, url in (rs or [])],
+                'error': None if e is None else str(e) or type(e).__name__
+            })
+        yield sse_event('end', {'count': count})
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @video_blu.route('/subject')
@@ -129,6 +171,17 @@ def manager():
 def init_manager(config_file):
     global config
     config = read_config_from_py_file(config_file)
+    init_video_db(config.video_db)
+    init_limiter(getattr(config, 'limiter_db', None))
+    init_browsers(getattr(config, 'browser_count', 2), getattr(config, 'browser_headless', True))
+    if getattr(config, 'cache_dir', None) is not None:
+        init_cache(FileCache(config.cache_dir))
+    init_cassette(getattr(config, 'cassette_dir', None), getattr(config, 'cassette_mode', 'replay'))
+    init_results(getattr(config, 'result_db', None))
+
+
+def sse_event(event, data):
+    return 'event: %s\ndata: %s\n\n' % (event, json.dumps(data, ensure_ascii=False))
 
 
 def archived_result(result):
@@ -9,7 +9,9 @@ import math
 import os
 import re
 import shutil
-from sqlite3 import connect, PARSE_DECLTYPES, Row
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from sqlite3 import connect, PARSE_DECLTYPES, Row, DatabaseError
 from urllib import parse
 
 import pythoncom
@@ -19,7 +21,9 @@ from tools.internet.douban import Douban, IMDb
 from tools.internet.downloader import IDM, Thunder
 from tools.internet.resource import VideoSearch80s, VideoSearchXl720, VideoSearchXLC, VideoSearchZhandi, \
     VideoSearchAxj
+from tools.internet.spider import probe_all
 from tools.utils import file
+from tools.utils.pipeline import run_pipeline, Stage
 from tools.video import Archived, Status, Subtype
 from tools.video.enums import Protocol
 
@@ -29,15 +33,36 @@ VIDEO_SUFFIXES = ('.avi', '.rmvb', '.mp4', '.mkv')
 movie_standard_kbps = 2000  # kb/s
 movie_standard_size = movie_standard_kbps * 7680  # B/min
 movie_duration_error = 60  # seconds
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'resources', 'video.sql')
+
+
+def init_video_db(db_path):
+    """
+    Create tables which don't exist yet, like sync_state added after the database, once the app starts.
+    """
+    con = connect(db_path)
+    try:
+        with open(SCHEMA_PATH, 'r', encoding='utf-8') as fp:
+            con.executescript(fp.read())
+    finally:
+        con.close()
 
 
 class VideoManager:
     CHINESE = ['汉语普通话', '普通话', '粤语', '闽南语', '河南方言', '贵州方言', '贵州独山话']
     JUNK_SITES = ['yutou.tv', '80s.la', '80s.im', '2tu.cc', 'bofang.cc:', 'dl.y80s.net', '80s.bz', 'xubo.cc']
     ALL_SITES = [VideoSearch80s(), VideoSearchXl720(), VideoSearchXLC(), VideoSearchZhandi(), VideoSearchAxj()]
+    IMDB = IMDb()  # shared by all managers, results of title_technical are cached
     SOURCE_FIELDS = ['id', 'title', 'alt', 'status', 'tag_date', 'original_title', 'aka', 'subtype', 'languages', 'year',
                      'durations', 'current_season', 'episodes_count', 'season_count', 'imdb']
     FIELDS = SOURCE_FIELDS + ['archived', 'location', 'source', 'last_update']
+    CRAWL_RETRIES = 20  # total retries of requests to Douban during a sync
+    DOUBAN_WORKERS = 2  # threads fetching details, still limited by the interval of the site
+    IMDB_WORKERS = 2
+    QUEUE_SIZE = 8  # max subjects waiting for each stage
+    BATCH_SIZE = 20  # subjects inserted in one transaction
+    PROBE_TIMEOUT = 5  # seconds to probe a download url without retries, which only ranks links for IDM
+    ENRICH_ROUNDS = 2  # rounds to enrich new subjects, failed ones of a round are retried in the next round
 
     def __init__(self, cdn, db_path, idm_path, api_key) -> None:
         self.cdn = cdn
@@ -77,30 +102,108 @@ class VideoManager:
         If not exist in db, get full info and insert into db, with archived set to 0.
         If exists, update status and tag_date.
 
-        :param start_date: when tag_date start
+        Without start_date, each category is synced since its watermark, the latest subject synced last time. A
+        watermark is moved forward only if all new subjects of the category are saved, so failed ones are retried next
+        time.
+
+        :param start_date: when tag_date start, ignoring watermarks if specified
         """
-        subjects = dict([(x['id'], x) for x in self.get_movies()])
-        if start_date is None and len(subjects) > 0:
-            start_date = max([x['tag_date'] for x in subjects.values() if x['tag_date'] is not None])
+        watermarks = None
+        if start_date is None:
+            watermarks = self.get_sync_states(user_id)
+            if len(watermarks) < len(Douban.RECORD_CATEGORIES):
+                # categories never synced start from the latest movie in database
+                start_date = self.connection.execute('SELECT MAX(tag_date) FROM movie').fetchone()[0]
         logger.info('Start updating movies since %s', start_date if start_date else '')
         added_count = error_count = 0
-        for subject_id, subject in self.__douban.collect_user_movies(user_id, start_date=start_date).items():
-            subject['status'] = Status.from_name(Status, subject.get('status'))
-            subject_id = int(subject_id)
-            if subject_id in subjects:
-                self.update_movie(subject_id, **subject)
-            else:
-                try:
-                    subject.update(self.movie_subject(subject_id))
-                except Exception as e:
-                    error_count += 1
-                    logger.error(e)
-                    continue
-                if self.add_movie(subject):
-                    added_count += 1
+        marks, failed, new_subjects = {}, set(), []
+        with self.__douban.retry_budget(self.CRAWL_RETRIES):
+            subjects = self.__douban.collect_user_movies(user_id, start_date=start_date, watermarks=watermarks)
+            for subject_id, subject in subjects.items():
+                record_cat = subject['status']
+                if record_cat not in marks:
+                    marks[record_cat] = (subject['tag_date'], subject_id)
+                subject['status'] = Status.from_name(Status, record_cat)
+                subject_id = int(subject_id)
+                if self.get_movie(id=subject_id) is not None:
+                    self.update_movie(subject_id, **subject)
+                else:
+                    new_subjects.append(subject)
+
+            # failed subjects are retried after others
+            new_count = len(new_subjects)
+            for i in range(self.ENRICH_ROUNDS):
+                if len(new_subjects) == 0:
+                    break
+                retries, batch = [], []
+                for subject, result, failure in self.__enrich_subjects(new_subjects):
+                    if failure is not None:
+                        retries.append(subject)
+                        continue
+                    batch.append(result)
+                    if len(batch) >= self.BATCH_SIZE:
+                        added_count += self.__add_batch(batch, failed)
+                        batch = []
+                added_count += self.__add_batch(batch, failed)
+                new_subjects = retries
+            for subject in new_subjects:
+                logger.error('Failed to enrich subject: %s, %s', subject['id'], subject['title'])
+                failed.add(subject['status'].name)
+            # failed to enrich or to insert
+            error_count = new_count - added_count
+        for record_cat, (tag_date, subject_id) in marks.items():
+            if record_cat not in failed:
+                self.save_sync_state(user_id, record_cat, tag_date, int(subject_id))
         logger.info('Finish updating movies, %d movies added, %d errors', added_count, error_count)
         return added_count, error_count
 
+    def __enrich_subjects(self, subjects):
+        """
+        Get full info of simple subjects by a pipeline, fetching details from Douban and IMDb concurrently.
+        :return: generator of (simple subject, full subject or None, failure or None)
+        """
+
+        def douban_stage(subject):
+            result = subject.copy()
+            result.update(self.douban_subject(int(subject['id'])))
+            return result
+
+        def imdb_stage(subject):
+            self.imdb_durations(subject)
+            return dict([(k, v) for k, v in subject.items() if k in self.FIELDS])
+
+        return run_pipeline(subjects,
+                            Stage('douban', douban_stage, self.DOUBAN_WORKERS, self.QUEUE_SIZE),
+                            Stage('imdb', imdb_stage, self.IMDB_WORKERS, self.QUEUE_SIZE),
+                            out_size=self.BATCH_SIZE)
+
+    def __add_batch(self, subjects, failed: set):
+        """
+        :param failed: categories of subjects failed to add
+        :return: count of subjects added
+        """
+        if len(subjects) == 0:
+            return 0
+        results = self.add_movies(subjects)
+        for subject, added in zip(subjects, results):
+            if not added:
+                failed.add(subject['status'].name)
+        return sum(results)
+
+    def get_sync_states(self, user_id):
+        """
+        :return: {'<record_cat>': (tag_date, '<subject_id>')}
+        """
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT category, tag_date, subject_id FROM sync_state WHERE user_id = ?', (user_id,))
+        return dict([(x['category'], (x['tag_date'], str(x['subject_id']))) for x in cursor.fetchall()])
+
+    def save_sync_state(self, user_id, category, tag_date, subject_id):
+        con = self.connection
+        con.execute('INSERT OR REPLACE INTO sync_state(user_id, category, tag_date, subject_id, last_update) '
+                    'VALUES (?, ?, ?, ?, DATETIME(\'now\'))', (user_id, category, tag_date, subject_id))
+        con.commit()
+
     def archive_all(self):
         subjects = self.get_movies(order_by='last_update', desc='desc')
         archived_count = unarchived_count = 0
@@ -136,37 +239,109 @@ class VideoManager:
         return True
 
     def movie_subject(self, subject_id):
+        subject = self.douban_subject(subject_id)
+        self.imdb_durations(subject)
+        for k in subject.copy():
+            if k not in self.FIELDS:
+                del subject[k]
+        return subject
+
+    def douban_subject(self, subject_id):
+        """
+        :return: info of the subject from Douban, imdb as the int No.
+        """
         subject = self.__douban.movie_subject(subject_id)
         subject['subtype'] = Subtype.from_name(Subtype, subject['subtype'])
         subject['title'] = remove_redundant_spaces(subject['title'])
         subject['original_title'] = remove_redundant_spaces(subject['original_title'])
         remove_redundant_spaces(subject['aka'])
         subject['imdb'] = int(re.fullmatch(r'https://www.imdb.com/title/tt(\d+)', subject['imdb']).group(1))
+        return subject
+
+    def imdb_durations(self, subject):
+        """
+        Add durations from IMDb to the subject which are not in durations from Douban.
+        """
         ds = dict([(re.search(r'(\d+)', d).group(1), d) for d in subject['durations']])
-        for d in IMDb().title_technical(subject['imdb'])['durations']:
+        for d in self.IMDB.title_technical(subject['imdb'])['durations']:
             if re.match(r'(\d+)', d).group(1) not in ds:
                 subject['durations'].append(d)
 
-        for k in subject.copy():
-            if k not in self.FIELDS:
-                del subject[k]
-        return subject
-
     def search_resources(self, key):
         """
-        :return: sites and resources found
+        :return: ({site: resources found}, {site: reason}) of sites done and sites partial
         """
         resources = {}
         if isinstance(key, int):
             subject = self.get_movie(id=key)
             if subject is None:
                 logger.info('No subject found with id: %d', key)
-                return {}
-            for site in sorted(self.ALL_SITES, key=lambda x: x.priority):
-                resources[site] = site.search(subject)
-            return resources
+                return {}, {}
+            results, partial = self.query_sites(subject, 'search')
+            return results, partial
         if isinstance(key, str):
             pass
+        return resources, {}
+
+    def iter_sites(self, subject, method):
+        """
+        Query all sites concurrently, each of which is waited until its deadline.
+        :param method: 'search' or 'collect'
+        :return: generator of (site, result or None, error or None) in the order of completion. The error is a
+                TimeoutError if the site misses its deadline.
+        """
+        start = time.monotonic()
+        executor = ThreadPoolExecutor(max_workers=len(self.ALL_SITES), thread_name_prefix='site')
+        futures = dict([(executor.submit(getattr(site, method), subject), site) for site in self.ALL_SITES])
+        try:
+            while len(futures) > 0:
+                timeout = max(0.0, min([x.deadline for x in futures.values()]) - (time.monotonic() - start))
+                done, pending = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    site = futures.pop(future)
+                    if future.exception() is not None:
+                        logger.error('Failed to %s on %s: %s', method, site.name, future.exception())
+                        yield site, None, future.exception()
+                    else:
+                        yield site, future.result(), None
+                elapsed = time.monotonic() - start
+                for future in [x for x in pending if futures[x].deadline <= elapsed]:
+                    site = futures.pop(future)
+                    future.cancel()
+                    yield site, None, TimeoutError('Deadline of %ds exceeded' % site.deadline)
+        finally:
+            for future in futures:
+                future.cancel()
+            # sites missing deadlines are left running in the background
+            executor.shutdown(wait=False)
+
+    def query_sites(self, subject, method):
+        """
+        Query all sites concurrently.
+        :param method: 'search' or 'collect'
+        :return: ({site: result}, {site: error}) of sites done and sites failed or missing deadlines, both in
+                priority order
+        """
+        results, partial = {}, {}
+        for site, result, e in self.iter_sites(subject, method):
+            if e is None:
+                results[site] = result
+            else:
+                partial[site] = e
+        key = lambda x: x.priority
+        return dict([(x, results[x]) for x in sorted(results, key=key)]), dict([(x, partial[x]) for x in sorted(partial, key=key)])
+
+    def iter_search_resources(self, key):
+        """
+        Search resources on all sites concurrently.
+        :return: generator of (site, resources or None, error or None) as soon as each site finishes
+        """
+        if isinstance(key, int):
+            subject = self.get_movie(id=key)
+            if subject is None:
+                logger.info('No subject found with id: %d', key)
+                return
+            yield from self.iter_sites(subject, 'search')
 
     def collect_resources(self, subject_id: int):
         """
@@ -186,8 +361,10 @@ class VideoManager:
             return self.update_archived(subject_id, Archived.playable, location)
 
         links = dict([(v, {}) for v in Protocol.__members__.values()])
-        for site in sorted(self.ALL_SITES, key=lambda x: x.priority):
-            resources = site.collect(subject)
+        results, partial = self.query_sites(subject, 'collect')
+        for site, reason in partial.items():
+            logger.warning('Partial resources without site %s: %s', site.name, reason)
+        for site, resources in results.items():
             for url, remark in resources.items():
                 p, u = classify_url(url)
                 if any([(x in u) for x in self.JUNK_SITES]):
@@ -205,11 +382,21 @@ class VideoManager:
                     continue
                 links[p][u] = (u, filename, ext)
 
+        # drop dead links for IDM and download larger files first, Thunder may still fetch ftp links failing here
+        idm_links = {}
+        for p in [Protocol.http, Protocol.ftp]:
+            infos = probe_all(links[p].keys(), timeout=self.PROBE_TIMEOUT, retry=0)
+            for info in infos:
+                if info['code'] != 200:
+                    logger.info('Dead link: %s, %s', info['url'], info['msg'])
+            infos = sorted([x for x in infos if x['code'] == 200], key=lambda x: x['size'] or 0, reverse=True)
+            idm_links[p] = dict([(x['url'], links[p][x['url']]) for x in infos])
+
         dst_dir = os.path.join(self.__temp_dir, '%d_%s' % (subject_id, title))
         os.makedirs(dst_dir, exist_ok=True)
         url_count = 0
         for p in [Protocol.http, Protocol.ftp]:
-            for u, filename, ext in links[p].values():
+            for u, filename, ext in idm_links[p].values():
                 logger.info('Add IDM task of %s, downloading from %s to the temporary dir', title, u)
                 self.__idm.add_task(u, dst_dir, '%d_%s_%s_%d_%s' % (subject_id, title, p.name, url_count, filename))
                 url_count += 1
@@ -364,6 +551,29 @@ class VideoManager:
         con.commit()
         return True
 
+    def add_movies(self, subjects):
+        """
+        Insert subjects in one transaction
+        :return: list of whether each subject is added
+        """
+        con = self.connection
+        cursor = con.cursor()
+        results = []
+        for subject in subjects:
+            if subject.get('archived', None) is None:
+                subject['archived'] = Archived.added
+            if subject.get('status', None) is None:
+                subject['status'] = Status.unmarked
+            try:
+                cursor.execute('INSERT INTO movie(%s, last_update) VALUES (%s, DATETIME(\'now\'))'
+                               % (', '.join(subject.keys()), ', '.join([':' + x for x in subject])), subject)
+                results.append(cursor.rowcount == 1)
+            except DatabaseError as e:
+                logger.error('Failed to Add movie: %s, %s', subject['title'], e)
+                results.append(False)
+        con.commit()
+        return results
+
     def update_movie(self, subject_id: int, ignore_none=True, **kwargs):
         if ignore_none:
             for k, v in kwargs.copy().items():